@@ -0,0 +1,202 @@
+# Quiz analytics over the columnar answer log written by the bot
+#
+#   python analytics.py                           # summary, report to analytics.csv
+#   python analytics.py --log analytics --output report.csv
+#
+# The bot appends every finished quiz to ANALYTICS_DIR, one directory per
+# process and one file per column. Everything here is a bincount over those
+# columns, so millions of answers take well under a second.
+
+import argparse
+import csv
+import io
+import os
+import sys
+
+import numpy as np
+
+# Column files are raw little-endian arrays named <table>_<column>.<array typecode>
+DTYPES = {"q": "<i8", "d": "<f8", "I": "<u4", "B": "u1"}
+QUIZ_COLUMNS = (("user", "q"), ("finished", "d"))
+ANSWER_COLUMNS = (("quiz", "I"), ("qid", "I"), ("chosen", "B"))
+SCORE_BINS = 10  # Score distribution in 10% steps, 100% gets its own bin
+
+def read_columns(directory: str, table: str, columns: tuple) -> dict:
+    """Read one table of a log directory, trimmed to its complete rows"""
+    data = {}
+    for name, code in columns:
+        path = os.path.join(directory, f"{table}_{name}.{code}")
+        data[name] = np.fromfile(path, dtype=DTYPES[code]) if os.path.exists(path) else np.empty(0, DTYPES[code])
+    # A crash can leave one column a row ahead of the others
+    rows = min(len(values) for values in data.values())
+    return {name: values[:rows] for name, values in data.items()}
+
+def load_log(root: str) -> tuple:
+    """All quizzes and answers under root, with quiz numbers made unique across writers"""
+    quizzes, answers = [], []
+    offset = 0
+    directories = sorted(entry.path for entry in os.scandir(root) if entry.is_dir()) if os.path.isdir(root) else []
+    for directory in directories:
+        quiz = read_columns(directory, "quizzes", QUIZ_COLUMNS)
+        answer = read_columns(directory, "answers", ANSWER_COLUMNS)
+        # Answers of a quiz whose own row was lost cannot be attributed
+        keep = answer["quiz"] < len(quiz["user"])
+        answer = {name: values[keep] for name, values in answer.items()}
+        answer["quiz"] = answer["quiz"].astype(np.int64) + offset
+        offset += len(quiz["user"])
+        quizzes.append(quiz)
+        answers.append(answer)
+
+    def concat(parts: list, columns: tuple) -> dict:
+        return {
+            name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, DTYPES[code])
+            for name, code in columns
+        }
+
+    return concat(quizzes, QUIZ_COLUMNS), concat(answers, ANSWER_COLUMNS)
+
+def question_categories(levels, question_count: int) -> tuple:
+    """Category and level index of every question id, plus their names"""
+    categories = list(levels)
+    level_names = sorted({level for pools in levels.values() for level in pools})
+    category_of = np.full(question_count, -1, dtype=np.int32)
+    level_of = np.full(question_count, -1, dtype=np.int32)
+    for index, category in enumerate(categories):
+        for level, ids in levels[category].items():
+            category_of[ids.start:ids.stop] = index
+            level_of[ids.start:ids.stop] = level_names.index(level)
+    return category_of, level_of, categories, level_names
+
+def answer_counts(answers: dict, question_count: int) -> tuple:
+    """How often each question id was answered, and answered wrong"""
+    known = answers["qid"] < question_count
+    qid = answers["qid"][known]
+    shown = np.bincount(qid, minlength=question_count)
+    wrong = np.bincount(qid[answers["chosen"][known] != 0], minlength=question_count)
+    return shown, wrong
+
+def analyze(quizzes: dict, answers: dict, levels, question_count: int) -> dict:
+    """Per-question error and answer pick rates, per-category score distributions"""
+    category_of, level_of, categories, level_names = question_categories(levels, question_count)
+    # Ids past the end of the current bank belong to questions that were removed
+    known = answers["qid"] < question_count
+    qid = answers["qid"][known].astype(np.int64)
+    chosen = answers["chosen"][known].astype(np.int64)
+    quiz = answers["quiz"][known]
+
+    # picks[q, i] counts how often original answer i of question q was chosen, 0 is correct
+    picks = np.bincount(qid * 4 + chosen, minlength=question_count * 4).reshape(question_count, 4)
+    shown = picks.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error_rate = np.where(shown > 0, 1 - picks[:, 0] / shown, np.nan)
+        pick_rate = np.where(shown[:, None] > 0, picks / shown[:, None], np.nan)
+
+    # Score of every quiz with at least one answer. A quiz draws from a single
+    # category pool, so any of its questions gives its category; a retry of
+    # mistakes can mix categories and counts towards one of them
+    quiz_count = len(quizzes["user"])
+    answered = np.bincount(quiz, minlength=quiz_count)
+    correct = np.bincount(quiz, weights=chosen == 0, minlength=quiz_count)
+    taken = np.flatnonzero(answered)
+    sample = np.zeros(quiz_count, dtype=np.int64)
+    sample[quiz] = qid
+    quiz_category = category_of[sample[taken]]
+    score = correct[taken] / answered[taken]
+    score_bin = np.minimum((score * SCORE_BINS).astype(np.int64), SCORE_BINS)
+    valid = quiz_category >= 0
+    distribution = np.bincount(
+        quiz_category[valid] * (SCORE_BINS + 1) + score_bin[valid],
+        minlength=len(categories) * (SCORE_BINS + 1),
+    ).reshape(len(categories), SCORE_BINS + 1)
+    score_sum = np.bincount(quiz_category[valid], weights=score[valid], minlength=len(categories))
+
+    return {
+        "answers": len(qid),
+        "quizzes": len(taken),
+        "users": len(np.unique(quizzes["user"])),
+        "shown": shown,
+        "picks": picks,
+        "error_rate": error_rate,
+        "pick_rate": pick_rate,
+        "category_of": category_of,
+        "level_of": level_of,
+        "categories": categories,
+        "level_names": level_names,
+        "score_distribution": distribution,
+        "mean_score": np.divide(score_sum, distribution.sum(axis=1),
+                                out=np.full(len(categories), np.nan), where=distribution.sum(axis=1) > 0),
+    }
+
+def hardest(report: dict, limit: int = 10, min_shown: int = 5) -> np.ndarray:
+    """Ids of the questions answered wrong most often, among those shown at least min_shown times"""
+    candidates = np.flatnonzero(report["shown"] >= min_shown)
+    order = np.argsort(-report["error_rate"][candidates], kind="stable")
+    return candidates[order[:limit]]
+
+def summary(report: dict, questions, limit: int = 10) -> str:
+    """Admin-facing text of the report"""
+    lines = [
+        "📈 **Tahlil:**",
+        f"Testlar: {report['quizzes']}, javoblar: {report['answers']}, foydalanuvchilar: {report['users']}",
+        "",
+        "**Kategoriyalar bo'yicha natijalar** (0-100%, 10% qadam):",
+    ]
+    for index, category in enumerate(report["categories"]):
+        counts = report["score_distribution"][index]
+        if counts.sum():
+            lines.append(f"{category}: o'rtacha {report['mean_score'][index] * 100:.1f}%, "
+                         f"{counts.sum()} ta test | {' '.join(map(str, counts))}")
+
+    ids = hardest(report, limit)
+    if len(ids):
+        lines += ["", "**Eng qiyin savollar:**"]
+    for qid in ids:
+        q = questions[int(qid)]
+        distractor = 1 + int(np.argmax(report["picks"][qid, 1:]))
+        lines.append(f"{q.text[:80]}{'...' if len(q.text) > 80 else ''}\n"
+                     f"   xato: {report['error_rate'][qid] * 100:.0f}% ({report['shown'][qid]} marta), "
+                     f"ko'p tanlangan: {q.answers[distractor][:40]} "
+                     f"({report['pick_rate'][qid, distractor] * 100:.0f}%)")
+    return "\n".join(lines)
+
+def question_csv(report: dict, questions) -> bytes:
+    """Per-question report of every question that was shown at least once"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["question_id", "category", "level", "shown", "error_rate",
+                     "correct_rate", "answer_1_rate", "answer_2_rate", "answer_3_rate", "question"])
+    for qid in np.flatnonzero(report["shown"]):
+        writer.writerow([
+            int(qid),
+            report["categories"][report["category_of"][qid]],
+            report["level_names"][report["level_of"][qid]],
+            int(report["shown"][qid]),
+            f"{report['error_rate'][qid]:.4f}",
+            *(f"{rate:.4f}" for rate in report["pick_rate"][qid]),
+            questions[int(qid)].text,
+        ])
+    # BOM so spreadsheet programs detect UTF-8
+    return out.getvalue().encode("utf-8-sig")
+
+def run(root: str, bank) -> tuple:
+    """Load the log and analyze it against a question bank; returns (summary, CSV report)"""
+    quizzes, answers = load_log(root)
+    report = analyze(quizzes, answers, bank.levels, len(bank))
+    return summary(report, bank.questions), question_csv(report, bank.questions)
+
+def main():
+    import bot as quizbot
+
+    parser = argparse.ArgumentParser(description="Quiz answer analytics")
+    parser.add_argument("--log", default=quizbot.ANALYTICS_DIR)
+    parser.add_argument("--output", default="analytics.csv")
+    args = parser.parse_args()
+
+    text, report = run(args.log, quizbot.question_bank)
+    with open(args.output, "wb") as f:
+        f.write(report)
+    print(text)
+    print(f"Saved {args.output}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# Offline load benchmark: feeds synthetic quiz flows straight into the Dispatcher
+#
+#   python benchmark.py                          # 100, 1k and 10k concurrent users
+#   python benchmark.py --scales 1000 --answers 20 --output after.json
+#   python benchmark.py --compare before.json --output after.json
+#
+# Each scale runs in a fresh process so peak RSS is measured per scale. Bot API
+# calls go to the harness FakeSession, nothing touches the network.
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from harness import FakeSession, UpdateFactory, disable_rate_limits, percentile
+from aiogram.types import Update
+
+import bot as quizbot
+
+def timed(name: str, func, samples: dict):
+    """Wrap a bot function so every call records its duration"""
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples[name].append(time.perf_counter() - started)
+    else:
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples[name].append(time.perf_counter() - started)
+    return wrapper
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+async def run_scale(users: int, answers: int, latency: float, rate_limits: bool) -> dict:
+    samples = defaultdict(list)
+    # Functions called by name from the handlers, so patching the module is enough
+    for name in ("send_question", "add_user_info", "finish_quiz"):
+        setattr(quizbot, name, timed(name, getattr(quizbot, name), samples))
+
+    if not rate_limits:
+        disable_rate_limits()
+    quizbot.MAX_SESSIONS = max(quizbot.MAX_SESSIONS, users)
+    quizbot.bot.session = FakeSession(latency)
+    await quizbot.on_startup()
+
+    factory = UpdateFactory()
+    max_tasks = 0
+    sampling = True
+
+    async def sample_tasks():
+        nonlocal max_tasks
+        while sampling:
+            max_tasks = max(max_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(0.01)
+
+    async def run_user(user_id: int):
+        for kind, data in factory.flow(user_id, answers):
+            update = Update.model_validate(data, context={"bot": quizbot.bot})
+            started = time.perf_counter()
+            await quizbot.dp.feed_update(quizbot.bot, update)
+            samples[kind].append(time.perf_counter() - started)
+
+    sampler = asyncio.create_task(sample_tasks())
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(2_000_000 + i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    sampling = False
+    await sampler
+    await quizbot.on_shutdown()
+
+    updates = sum(len(samples[kind]) for kind in ("start", "category", "difficulty", "count", "timer", "answer"))
+    return {
+        "users": users,
+        "answers": answers,
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "max_tasks": max_tasks,
+        "api_calls": quizbot.bot.session.calls,
+        "latency_ms": {
+            kind: {
+                "count": len(values),
+                "p50": round(percentile(values, 0.50) * 1000, 3),
+                "p99": round(percentile(values, 0.99) * 1000, 3),
+            }
+            for kind, values in sorted(samples.items())
+        },
+    }
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+def compare(before: dict, after: dict):
+    """Print p50/p99 changes per scale and update kind"""
+    previous = {run["users"]: run for run in before["runs"]}
+    for run in after["runs"]:
+        old = previous.get(run["users"])
+        if old is None:
+            continue
+        print(f"\n{run['users']} users: {old['updates_per_s']:.0f} -> {run['updates_per_s']:.0f} updates/s, "
+              f"RSS {old['peak_rss_mb']} -> {run['peak_rss_mb']} MB")
+        for kind, stats in run["latency_ms"].items():
+            if kind not in old["latency_ms"]:
+                continue
+            was = old["latency_ms"][kind]
+            print(f"  {kind:<14} p50 {was['p50']:>8.3f} -> {stats['p50']:>8.3f} ms   "
+                  f"p99 {was['p99']:>8.3f} -> {stats['p99']:>8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline quiz bot benchmark")
+    parser.add_argument("--scales", default="100,1000,10000", help="comma separated concurrent user counts")
+    parser.add_argument("--answers", type=int, default=10, help="questions answered per user")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency in seconds")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the production outbound rate limits")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: run one scale and report it on stdout
+        result = asyncio.run(run_scale(args.single, args.answers, args.latency, args.rate_limits))
+        print(json.dumps(result))
+        return
+
+    runs = []
+    for users in (int(value) for value in args.scales.split(",")):
+        child = subprocess.run(
+            [sys.executable, __file__, "--single", str(users), "--answers", str(args.answers),
+             "--latency", str(args.latency)] + (["--rate-limits"] if args.rate_limits else []),
+            capture_output=True, text=True, check=True,
+        )
+        run = json.loads(child.stdout.strip().splitlines()[-1])
+        runs.append(run)
+        print(f"{users:>6} users: {run['updates_per_s']:>9.0f} updates/s, "
+              f"answer p50 {run['latency_ms']['answer']['p50']:.3f} ms, "
+              f"p99 {run['latency_ms']['answer']['p99']:.3f} ms, "
+              f"peak RSS {run['peak_rss_mb']} MB, max tasks {run['max_tasks']}")
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
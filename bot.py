@@ -420,18 +420,45 @@
 
 
 import json
+import math
 import random
+import sys
+import itertools
+from array import array
 import asyncio
 import time
+import signal
+import argparse
+import multiprocessing
+import shutil
+import tempfile
 import logging
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
 from aiogram.filters import Command
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError, TelegramBadRequest
+from aiogram import methods
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
 from typing import Dict, Optional
+from types import MappingProxyType
 import weakref
 import gc
 from datetime import datetime
 import os
+import enum
+import sqlite3
+import hashlib
+import hmac
+import threading
+import bisect
+import mmap
+import re
+import struct
+import msgpack
+import analytics
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -442,116 +469,1200 @@ API_TOKEN = "8391048862:AAHFv9X4L4CGxpvJs_6uvQp-Mb5MVMvaddo"
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 
-# Load questions from JSON (load once at startup)
+# Question bank source; replace it atomically (write a new file, then rename),
+# the running bot reads question text straight from the mapped file
+QUESTIONS_PATH = os.getenv("QUESTIONS_PATH", "questions.json")
+QUESTIONS_INDEX_PATH = QUESTIONS_PATH + ".idx"  # Offsets index cached between starts
+QUESTIONS_COMPILED_PATH = os.getenv("QUESTIONS_COMPILED_PATH", "questions.bin")  # Built by compile_questions.py
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", "10000"))  # Decoded questions kept in memory
+
+def level_sort_key(level: str):
+    """Order numeric difficulty levels numerically, then any others by name"""
+    return (0, int(level), "") if level.isdigit() else (1, 0, level)
+
+ANSWER_KEYS = ("true_answer", "answer_1", "answer_2", "answer_3")
+# Every ordering of the four answers; answer buttons carry an index into this table
+PERMUTATIONS = tuple(itertools.permutations(range(len(ANSWER_KEYS))))
+
+class Question:
+    """A single question; answers[0] is the correct answer"""
+    __slots__ = ("id", "text", "answers")
+
+    def __init__(self, qid: int, text: str, answers: tuple):
+        self.id = qid
+        self.text = text
+        self.answers = answers
+
+# Flat objects (questions) as single tokens, then JSON strings and structural
+# characters; numbers and literals are not needed to follow the document layout
+JSON_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+JSON_TOKEN = re.compile(rb'\{[^{}\[\]"]*(?:' + JSON_STRING + rb'[^{}\[\]"]*)*\}|' + JSON_STRING + rb'|[{}\[\]:,]')
+QUESTION_KEYS = tuple(json.dumps(key).encode() for key in ("question",) + ANSWER_KEYS)
+
+def scan_questions(buf, strict: bool = False) -> tuple:
+    """Index a {"categories": [...]} document without decoding it
+
+    Returns (starts, ends, levels): byte offsets of every question object, ids
+    being positions in those arrays, and category -> {level: range of ids}.
+    Questions of one level get consecutive ids, levels in level_sort_key order.
+    Questions missing a field are skipped, or raise ValueError when strict.
+    """
+    starts, ends = array("Q"), array("Q")
+    levels = {}
+    # Open containers: [is_object, current key or array index]
+    stack = []
+    expect_key = False
+    category_name = None
+    category_levels = {}  # raw level key -> array of start, end offset pairs of the open category
+
+    for match in JSON_TOKEN.finditer(buf):
+        token = match[0]
+        char = token[0]
+        if char == 0x22:  # string
+            top = stack[-1]
+            if expect_key:
+                top[1] = token
+            elif len(stack) == 3 and top[1] == b'"category"':
+                category_name = json.loads(token)
+        elif char == 0x7b and token[-1] == 0x7d:  # flat object
+            if len(stack) != 5 or stack[0][1] != b'"categories"' or stack[2][1] != b'"difficulty_levels"':
+                continue
+            for key in QUESTION_KEYS:
+                if key not in token:
+                    if strict:
+                        raise ValueError(f"question without {key.decode()} at byte {match.start()}")
+                    logger.warning(f"Skipping question without {key.decode()} at byte {match.start()}")
+                    break
+            else:
+                offsets = category_levels.get(stack[3][1])
+                if offsets is None:
+                    offsets = category_levels[stack[3][1]] = array("Q")
+                offsets.append(match.start())
+                offsets.append(match.end())
+        elif char == 0x3a:  # ':'
+            expect_key = False
+        elif char == 0x2c:  # ','
+            top = stack[-1]
+            if top[0]:
+                expect_key = True
+            else:
+                top[1] += 1
+        elif char == 0x7b or char == 0x5b:  # '{' or '['
+            stack.append([char == 0x7b, None if char == 0x7b else 0])
+            expect_key = char == 0x7b
+        else:  # '}' or ']'
+            if not stack:
+                raise ValueError(f"unbalanced {token.decode()} at byte {match.start()}")
+            top = stack.pop()
+            if len(stack) == 2 and top[0] and stack[0][1] == b'"categories"':
+                # A category object closed: number its questions level by level
+                pools = {}
+                decoded = {json.loads(raw): raw for raw in category_levels}
+                for level in sorted(decoded, key=level_sort_key):
+                    start = len(starts)
+                    offsets = category_levels[decoded[level]]
+                    starts.extend(offsets[0::2])
+                    ends.extend(offsets[1::2])
+                    pools[level] = range(start, len(starts))
+                if category_name is not None:
+                    levels[category_name] = pools
+                category_name = None
+                category_levels = {}
+    if stack:
+        raise ValueError("unexpected end of document")
+    return starts, ends, levels
+
+class LazyQuestions:
+    """Questions decoded on demand from the mapped source file, recent ones cached"""
+
+    def __init__(self, buf, starts: array, ends: array, cache_size: int = QUESTION_CACHE_SIZE):
+        self.buf = buf
+        self.starts = starts
+        self.ends = ends
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[int, Question]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, qid: int) -> Question:
+        q = self.cache.get(qid)
+        if q is not None:
+            self.cache.move_to_end(qid)
+            return q
+        item = json.loads(self.raw(qid))
+        q = Question(qid, str(item["question"]), tuple(str(item[key]) for key in ANSWER_KEYS))
+        self.cache[qid] = q
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return q
+
+    def raw(self, qid: int) -> bytes:
+        """Source JSON of a question"""
+        return self.buf[self.starts[qid]:self.ends[qid]]
+
+class QuestionBank:
+    """Immutable question store addressed by integer ids, with lookup tables and keyboards"""
+
+    def __init__(self, questions, levels: dict, version: str = "", signature: Optional[tuple] = None):
+        self.version = version
+        self.signature = signature  # (size, mtime_ns) of the source file
+        self.questions = questions
+        self.levels = MappingProxyType({
+            category: MappingProxyType(pools) for category, pools in levels.items()
+        })
+        self.categories = tuple(levels)
+        # Difficulty levels that exist in at least one category
+        self.difficulty_levels = tuple(sorted(
+            {level for cat_levels in levels.values() for level in cat_levels},
+            key=level_sort_key,
+        ))
+
+        self.category_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=category, callback_data=f"cat_{category}")]
+            for category in self.categories
+        ])
+        self.difficulty_keyboards = MappingProxyType({
+            category: InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=f"{level}-daraja", callback_data=f"diff_{level}")]
+                for level in cat_levels
+            ])
+            for category, cat_levels in levels.items()
+        })
+
+    def __len__(self):
+        return len(self.questions)
+
+    def pool(self, category: str, level: str) -> Optional[range]:
+        """Question ids of a category at a difficulty level, or None if missing"""
+        cat_levels = self.levels.get(category)
+        return cat_levels.get(level) if cat_levels is not None else None
+
+    @classmethod
+    def load(cls, path: str, index_path: Optional[str] = None, strict: bool = False,
+             compiled_path: Optional[str] = None) -> "QuestionBank":
+        """Map a questions.json file and index it, or use its compiled form if that is up to date"""
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            index = load_question_index(index_path, stat) if index_path else None
+            # Question ids are positions in this file, persisted sessions are tied to its hash.
+            # Hashed through reads, so a compiled bank does not keep the JSON pages resident
+            version = index[0] if index is not None else file_version(f)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if compiled_path:
+                bank = load_compiled_bank(compiled_path, version, signature)
+                if bank is not None:
+                    return bank
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if index is None:
+            starts, ends, levels = scan_questions(buf, strict)
+            if index_path:
+                save_question_index(index_path, stat, version, starts, ends, levels)
+        else:
+            _, starts, ends, levels = index
+        return cls(LazyQuestions(buf, starts, ends), levels, version, signature)
+
+def file_version(f) -> str:
+    """Short blake2b hex digest of a file's contents"""
+    digest = hashlib.blake2b(digest_size=8)
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def load_question_index(path: str, stat: os.stat_result) -> Optional[tuple]:
+    """Return (version, starts, ends, levels) if the index was built from this exact file"""
+    try:
+        with open(path, "rb") as f:
+            size, mtime_ns, version, starts, ends, levels = msgpack.unpackb(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable question index {path}: {e}")
+        return None
+    if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+        return None
+    levels = {
+        category: {level: range(*bounds) for level, bounds in pools}
+        for category, pools in levels
+    }
+    return version, array("Q", starts), array("Q", ends), levels
+
+def save_question_index(path: str, stat: os.stat_result, version: str, starts: array, ends: array, levels: dict):
+    """Write the offsets index next to the bank so the next start can skip the scan"""
+    record = msgpack.packb((
+        stat.st_size, stat.st_mtime_ns, version, starts.tobytes(), ends.tobytes(),
+        [(category, [(level, (ids.start, ids.stop)) for level, ids in pools.items()])
+         for category, pools in levels.items()],
+    ))
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(record)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not write question index {path}: {e}")
+
+# Compiled bank layout, all integers little-endian:
+#   header                  magic, format, blake2b-64 digest of the source JSON,
+#                           level count, question count
+#   level table             per (category, level): category and level names as
+#                           string refs, first id, end id
+#   question records        per id: text and the four answers as string refs,
+#                           answers[0] being the correct one
+#   string table            UTF-8, each distinct string stored once
+# A string ref is an (offset, length) pair into the string table.
+COMPILED_MAGIC = b"QBK1"
+COMPILED_HEADER = struct.Struct("<4sH2x8sII")
+COMPILED_LEVEL = struct.Struct("<6I")
+COMPILED_QUESTION = struct.Struct("<10I")
+
+class CompiledQuestions:
+    """Questions read from the fixed-width records of a mapped compiled bank"""
+
+    def __init__(self, buf, count: int, records: int, strings: int):
+        self.buf = buf
+        self.count = count
+        self.records = records  # Offset of the question records
+        self.strings = strings  # Offset of the string table
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, qid: int) -> Question:
+        if not 0 <= qid < self.count:
+            raise IndexError(qid)
+        refs = COMPILED_QUESTION.unpack_from(self.buf, self.records + qid * COMPILED_QUESTION.size)
+        text, *answers = (self.string(refs[i], refs[i + 1]) for i in range(0, len(refs), 2))
+        return Question(qid, text, tuple(answers))
+
+    def string(self, offset: int, length: int) -> str:
+        start = self.strings + offset
+        return self.buf[start:start + length].decode("utf-8")
+
+def load_compiled_bank(path: str, version: str, signature: Optional[tuple] = None) -> Optional[QuestionBank]:
+    """Map a compiled bank, or return None if it is missing or built from another source version"""
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        magic, _, digest, level_count, question_count = COMPILED_HEADER.unpack_from(buf)
+    except struct.error:
+        magic = None
+    if magic != COMPILED_MAGIC or digest.hex() != version:
+        logger.info(f"Compiled question bank {path} is stale, reading the JSON source")
+        buf.close()
+        return None
+
+    records = COMPILED_HEADER.size + level_count * COMPILED_LEVEL.size
+    questions = CompiledQuestions(buf, question_count, records, records + question_count * COMPILED_QUESTION.size)
+    levels = {}
+    for category_offset, category_length, level_offset, level_length, start, stop in COMPILED_LEVEL.iter_unpack(
+        buf[COMPILED_HEADER.size:records]
+    ):
+        category = questions.string(category_offset, category_length)
+        levels.setdefault(category, {})[questions.string(level_offset, level_length)] = range(start, stop)
+    return QuestionBank(questions, levels, version, signature)
+
 try:
-    with open("questions.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    logger.info(f"Loaded {len(data.get('categories', []))} categories")
+    question_bank = QuestionBank.load(QUESTIONS_PATH, QUESTIONS_INDEX_PATH, compiled_path=QUESTIONS_COMPILED_PATH)
+    logger.info(f"Indexed {len(question_bank)} questions in {len(question_bank.categories)} categories")
 except FileNotFoundError:
-    logger.error("questions.json not found!")
-    data = {"categories": []}
-except json.JSONDecodeError:
-    logger.error("Invalid JSON in questions.json!")
-    data = {"categories": []}
+    logger.error(f"{QUESTIONS_PATH} not found!")
+    question_bank = QuestionBank((), {})
+except (ValueError, IndexError) as e:
+    # ValueError is also raised by mmap for an empty file
+    logger.error(f"Invalid JSON in {QUESTIONS_PATH}: {e}")
+    question_bank = QuestionBank((), {})
+
+# Banks still referenced by sessions, by version; a quiz keeps the bank it started
+# with when questions.json is reloaded, and the old bank goes once those sessions end
+question_banks: "weakref.WeakValueDictionary[str, QuestionBank]" = weakref.WeakValueDictionary()
+question_banks[question_bank.version] = question_bank
+
+QUESTIONS_RELOAD_INTERVAL = float(os.getenv("QUESTIONS_RELOAD_INTERVAL", "5"))  # Seconds between mtime checks, 0 disables
+
+def validate_questions(questions: LazyQuestions, limit: int = 20) -> list:
+    """Describe questions with missing, empty or duplicate answers, up to limit of them"""
+    errors = []
+    for qid in range(len(questions)):
+        item = json.loads(questions.raw(qid))
+        answers = [item.get(key) for key in ANSWER_KEYS]
+        if not isinstance(item.get("question"), str) or not all(isinstance(a, str) and a.strip() for a in answers):
+            errors.append(f"question {qid}: missing or empty text")
+        elif len({a.strip() for a in answers}) < len(answers):
+            errors.append(f"question {qid}: duplicate answers")
+        if len(errors) >= limit:
+            break
+    return errors
+
+def load_validated_bank(path: str, index_path: str) -> QuestionBank:
+    """Load and check a new bank; runs in a worker thread"""
+    bank = QuestionBank.load(path, index_path, strict=True)
+    errors = validate_questions(bank.questions)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return bank
+
+async def reload_questions() -> bool:
+    """Swap in questions.json if it changed and is valid; running quizzes are not affected"""
+    global question_bank
+    try:
+        bank = await asyncio.to_thread(load_validated_bank, QUESTIONS_PATH, QUESTIONS_INDEX_PATH)
+    except Exception as e:
+        logger.error(f"Keeping question bank {question_bank.version}, reload failed: {e}")
+        return False
+    if bank.version == question_bank.version:
+        question_bank.signature = bank.signature
+        return False
+    # A single assignment on the event loop, handlers see either bank but never a mix
+    question_banks[bank.version] = bank
+    question_bank = bank
+    logger.info(f"Reloaded question bank {bank.version}: {len(bank)} questions in {len(bank.categories)} categories")
+    return True
+
+async def watch_questions():
+    """Poll the mtime of questions.json and reload it when it changes"""
+    checked = question_bank.signature
+    while True:
+        await asyncio.sleep(QUESTIONS_RELOAD_INTERVAL)
+        try:
+            stat = os.stat(QUESTIONS_PATH)
+        except OSError:
+            continue
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if signature == checked:
+            continue
+        # A failed reload is retried only after the next change
+        checked = signature
+        await reload_questions()
+
+class SessionState(enum.Enum):
+    CHOOSING_CATEGORY = 1
+    CHOOSING_DIFFICULTY = 2
+    AWAITING_COUNT = 3
+    AWAITING_TIMER = 4
+    IN_QUIZ = 5
+
+SESSION_FORMAT = 2  # Bump when the packed Session layout changes
+
+class Session:
+    """Quiz state of a single user"""
+    __slots__ = (
+        "user_id", "chat_id", "state", "category", "difficulty", "questions_pool", "count",
+        "timer", "score", "answered", "quiz", "current_index", "answers",
+        "message_id", "bank", "start_time", "last_activity",
+    )
+
+    def __init__(self, user_id: int, chat_id: int = 0):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.state = SessionState.CHOOSING_CATEGORY
+        self.category = None
+        self.difficulty = None
+        self.questions_pool = None
+        self.count = 0
+        self.timer = 0
+        self.score = 0
+        self.answered = 0
+        # Question ids of this quiz and the chosen answer index for each answered one
+        self.quiz = None
+        self.current_index = 0
+        self.answers = None
+        self.message_id = None  # Message showing the current question
+        self.start_time = 0.0
+        self.last_activity = time.time()
+        self.bank = question_bank  # Question ids refer to this bank version
+
+    @property
+    def deadline(self) -> float:
+        """Wall-clock time when the running quiz runs out"""
+        return self.start_time + self.timer
+
+    def pack(self) -> bytes:
+        """Serialize to a compact msgpack record"""
+        pool = self.questions_pool
+        if isinstance(pool, range):
+            pool = (pool.start, pool.stop)
+        elif pool is not None:
+            pool = array("I", pool).tobytes()
+        return msgpack.packb((
+            SESSION_FORMAT, self.bank.version, self.user_id, self.chat_id, self.state.value,
+            self.category, self.difficulty, pool, self.count, self.timer,
+            self.score, self.answered, self.quiz.tobytes() if self.quiz is not None else None,
+            self.current_index, bytes(self.answers) if self.answers is not None else None,
+            self.start_time, self.last_activity, self.message_id,
+        ))
+
+    @classmethod
+    def unpack(cls, blob: bytes) -> Optional["Session"]:
+        """Restore a session, or None if it refers to another format or an unloaded question bank"""
+        record = msgpack.unpackb(blob)
+        bank = question_banks.get(record[1])
+        if record[0] != SESSION_FORMAT or bank is None:
+            return None
+        (_, _, user_id, chat_id, state, category, difficulty, pool, count, timer,
+         score, answered, quiz, current_index, answers, start_time,
+         last_activity, message_id) = record
+        session = cls(user_id, chat_id)
+        session.bank = bank
+        session.state = SessionState(state)
+        session.category = category
+        session.difficulty = difficulty
+        if isinstance(pool, list):
+            session.questions_pool = range(*pool)
+        elif pool is not None:
+            session.questions_pool = array("I", pool)
+        session.count = count
+        session.timer = timer
+        session.score = score
+        session.answered = answered
+        session.quiz = array("I", quiz) if quiz is not None else None
+        session.current_index = current_index
+        session.answers = bytearray(answers) if answers is not None else None
+        session.start_time = start_time
+        session.last_activity = last_activity
+        session.message_id = message_id
+        return session
+
+class SessionStore:
+    """In-memory sessions ordered from least to most recently active"""
+
+    def __init__(self):
+        self.sessions: "OrderedDict[int, Session]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.sessions
+
+    def __getitem__(self, user_id: int) -> Session:
+        return self.sessions[user_id]
+
+    def get(self, user_id: int) -> Optional[Session]:
+        return self.sessions.get(user_id)
+
+    def add(self, session: Session):
+        """Store a session as the most recently active one"""
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        self.save(session)
+
+    def touch(self, user_id: int):
+        self.sessions.move_to_end(user_id)
+
+    def oldest(self) -> Optional[Session]:
+        return next(iter(self.sessions.values()), None)
+
+    def remove(self, user_id: int):
+        self.sessions.pop(user_id, None)
+
+    def save(self, session: Session):
+        """Persist a changed session; nothing to do in memory"""
+
+    def load(self) -> list:
+        """Rehydrate persisted sessions at startup"""
+        return []
+
+    def close(self):
+        pass
+
+class SqliteSessionStore(SessionStore):
+    """Sessions kept in memory and written through to SQLite as msgpack blobs"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+
+    def save(self, session: Session):
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data) VALUES (?, ?)",
+                (session.user_id, session.pack()),
+            )
+        except Exception as e:
+            logger.error(f"Error saving session for user {session.user_id}: {e}")
+
+    def remove(self, user_id: int):
+        super().remove(user_id)
+        try:
+            self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        except Exception as e:
+            logger.error(f"Error deleting session for user {user_id}: {e}")
+
+    def load(self) -> list:
+        stale = []
+        # A shard worker only takes the sessions of its own users
+        for user_id, blob in self.conn.execute(
+            "SELECT user_id, data FROM sessions WHERE user_id % ? = ?", (SHARD_COUNT, SHARD_INDEX)
+        ):
+            try:
+                session = Session.unpack(blob)
+            except Exception as e:
+                logger.error(f"Corrupt session for user {user_id}: {e}")
+                session = None
+            if session is None:
+                stale.append((user_id,))
+            else:
+                self.sessions[user_id] = session
+        if stale:
+            self.conn.executemany("DELETE FROM sessions WHERE user_id = ?", stale)
+        # Restore activity order
+        for session in sorted(self.sessions.values(), key=lambda s: s.last_activity):
+            self.sessions.move_to_end(session.user_id)
+        return list(self.sessions.values())
+
+    def close(self):
+        self.conn.close()
+
+# Session backend: "memory" (lost on restart) or "sqlite" (survives restarts)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSIONS_DB = os.getenv("SESSIONS_DB", "sessions.db")
+
+# This process serves users with user_id % SHARD_COUNT == SHARD_INDEX; set in the
+# worker processes of the sharded mode
+SHARD_COUNT = 1
+SHARD_INDEX = 0
 
 # Store user sessions with memory management
-user_sessions: Dict[int, dict] = {}
-timer_tasks: Dict[int, asyncio.Task] = {}
+user_sessions: SessionStore = SqliteSessionStore(SESSIONS_DB) if SESSION_BACKEND == "sqlite" else SessionStore()
+
+class TimerWheel:
+    """Hashed timer wheel driven by a single task, holding one deadline per user"""
+
+    def __init__(self, tick: float = 1.0, size: int = 512):
+        self.tick = tick
+        # Each slot maps user_id -> (deadline tick, callback, args)
+        self.slots = [{} for _ in range(size)]
+        self.entries: Dict[int, int] = {}  # user_id -> slot index
+        self.current = int(time.monotonic() / tick)
+        self.task: Optional[asyncio.Task] = None
+        self.fired = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.entries
+
+    def schedule(self, user_id: int, delay: float, callback, *args):
+        """Run callback(*args) after delay seconds, replacing any pending deadline"""
+        self.cancel(user_id)
+        deadline = max(math.ceil((time.monotonic() + delay) / self.tick), self.current + 1)
+        slot = deadline % len(self.slots)
+        self.slots[slot][user_id] = (deadline, callback, args)
+        self.entries[user_id] = slot
+
+    def cancel(self, user_id: int):
+        slot = self.entries.pop(user_id, None)
+        if slot is not None:
+            del self.slots[slot][user_id]
+
+    def advance(self, now_tick: int):
+        """Fire every deadline up to now_tick, visiting only the slots that passed"""
+        while self.current < now_tick:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            due = [user_id for user_id, entry in slot.items() if entry[0] <= self.current]
+            for user_id in due:
+                _, callback, args = slot.pop(user_id)
+                del self.entries[user_id]
+                task = asyncio.create_task(callback(*args))
+                self.fired.add(task)
+                task.add_done_callback(self.fired.discard)
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            await asyncio.sleep(self.tick - now % self.tick)
+            try:
+                self.advance(int(time.monotonic() / self.tick))
+            except Exception as e:
+                logger.error(f"Timer wheel error: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.current = int(time.monotonic() / self.tick)
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+timer_wheel = TimerWheel()
 
 # Configuration
 MAX_SESSIONS = 1000  # Maximum concurrent sessions
 SESSION_TIMEOUT = 3600  # 1 hour timeout for inactive sessions
+SESSION_EVICT_IDLE = 300  # When full, evict the oldest session if idle for 5 minutes
 ADMIN_USER_ID = 2112429027  # Your Telegram ID
 
-# User monitoring functions
-def load_user_data():
-    """Load user data from JSON file"""
+# User monitoring storage
+USERS_DB = os.getenv("USERS_DB", "users.db")
+USERS_JSON = "users.json"  # Legacy store: imported once, regenerated by /export
+USER_FLUSH_INTERVAL = 5  # Seconds between write-behind flushes of user visits
+USER_FLUSH_BATCH = 500  # Flush early once this many users are pending
+
+USER_FIELDS = (
+    "user_id", "first_name", "last_name", "username", "language_code",
+    "is_premium", "first_seen", "last_seen", "total_visits",
+)
+
+class UserStore:
+    """User registry in an SQLite table keyed by user_id"""
+
+    def __init__(self, path: str):
+        # Visits are buffered here and written in batches by flush()
+        self.pending: Dict[int, dict] = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")  # Shard workers share the file
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                first_name TEXT NOT NULL DEFAULT '',
+                last_name TEXT NOT NULL DEFAULT '',
+                username TEXT NOT NULL DEFAULT '',
+                language_code TEXT NOT NULL DEFAULT '',
+                is_premium INTEGER NOT NULL DEFAULT 0,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                total_visits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS users_first_seen ON users(first_seen);
+            CREATE INDEX IF NOT EXISTS users_last_seen ON users(last_seen);
+        """)
+        self.conn.commit()
+
+    def import_json(self, path: str) -> int:
+        """Import users from a legacy users.json file into an empty table"""
+        if not os.path.exists(path) or self.count() > 0:
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                users = json.load(f).get("users", [])
+        except Exception as e:
+            logger.error(f"Error importing {path}: {e}")
+            return 0
+
+        now = datetime.now().isoformat()
+        rows = [(
+            u["user_id"],
+            u.get("first_name") or "",
+            u.get("last_name") or "",
+            u.get("username") or "",
+            u.get("language_code") or "",
+            int(bool(u.get("is_premium"))),
+            u.get("first_seen") or now,
+            u.get("last_seen") or now,
+            u.get("total_visits", 0),
+        ) for u in users if "user_id" in u]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO users ({', '.join(USER_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(USER_FIELDS))})",
+                rows,
+            )
+        logger.info(f"Imported {len(rows)} users from {path}")
+        return len(rows)
+
+    def buffer_visit(self, user_info: dict) -> dict:
+        """Merge a visit into the pending batch without touching the disk"""
+        pending = self.pending.get(user_info["user_id"])
+        if pending is not None:
+            user_info["first_seen"] = pending["first_seen"]
+            user_info["total_visits"] += pending["total_visits"]
+        self.pending[user_info["user_id"]] = user_info
+        return user_info
+
+    def take_pending(self) -> Dict[int, dict]:
+        """Detach the pending batch so new visits start a fresh one"""
+        batch, self.pending = self.pending, {}
+        return batch
+
+    def restore_pending(self, batch: Dict[int, dict]):
+        """Merge a batch that failed to write back into the pending one"""
+        for user_id, user_info in batch.items():
+            pending = self.pending.get(user_id)
+            if pending is not None:
+                pending["first_seen"] = user_info["first_seen"]
+                pending["total_visits"] += user_info["total_visits"]
+            else:
+                self.pending[user_id] = user_info
+
+    def record_visits(self, users):
+        """Insert new users or bump the visit counters of existing ones"""
+        with self.lock, self.conn:
+            self.conn.executemany("""
+                INSERT INTO users (user_id, first_name, last_name, username, language_code,
+                                   is_premium, first_seen, last_seen, total_visits)
+                VALUES (:user_id, :first_name, :last_name, :username, :language_code,
+                        :is_premium, :first_seen, :last_seen, :total_visits)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    username = excluded.username,
+                    language_code = excluded.language_code,
+                    is_premium = excluded.is_premium,
+                    last_seen = excluded.last_seen,
+                    total_visits = users.total_visits + excluded.total_visits
+            """, users)
+
+    def get(self, user_id: int) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def recent(self, limit: int) -> list:
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM users ORDER BY last_seen DESC LIMIT ?", (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def all(self) -> list:
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM users ORDER BY rowid").fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def stats(self, since: str) -> tuple:
+        """Total users and users first seen at or after since"""
+        with self.lock:
+            return tuple(self.conn.execute(
+                "SELECT COUNT(*), COUNT(*) FILTER (WHERE first_seen >= ?) FROM users", (since,)
+            ).fetchone())
+
+    def export_json(self, path: str) -> int:
+        """Write every user to path in the users.json layout, one row at a time"""
+        total = 0
+        with self.lock, open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write('{\n  "users": [')
+            for row in self.conn.execute("SELECT * FROM users ORDER BY rowid"):
+                f.write(",\n    " if total else "\n    ")
+                f.write(json.dumps(self._to_dict(row), ensure_ascii=False, indent=2).replace("\n", "\n    "))
+                total += 1
+            f.write("\n  ]" if total else "]")
+            f.write(f',\n  "total_users": {total}\n}}')
+        os.replace(path + ".tmp", path)
+        return total
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        user = dict(row)
+        user["is_premium"] = bool(user["is_premium"])
+        return user
+
+user_store = UserStore(USERS_DB)
+user_store.import_json(USERS_JSON)
+user_flush_wakeup = asyncio.Event()
+
+# Every user-store call from a coroutine runs here, so a slow query or export only
+# ever holds these threads and never the event loop
+USER_STORE_WORKERS = int(os.getenv("USER_STORE_WORKERS", "2"))
+user_store_executor = ThreadPoolExecutor(max_workers=USER_STORE_WORKERS, thread_name_prefix="user-store")
+
+async def run_in_user_store(func, *args):
+    """Run a blocking user-store call on its bounded executor"""
+    return await asyncio.get_running_loop().run_in_executor(user_store_executor, func, *args)
+
+async def flush_user_visits():
+    """Write pending user visits in one transaction off the event loop"""
+    batch = user_store.take_pending()
+    if not batch:
+        return
     try:
-        if os.path.exists("users.json"):
-            with open("users.json", "r", encoding="utf-8") as f:
-                return json.load(f)
+        await run_in_user_store(user_store.record_visits, list(batch.values()))
+        logger.debug(f"Flushed {len(batch)} user visits")
     except Exception as e:
-        logger.error(f"Error loading user data: {e}")
-    return {"users": [], "total_users": 0}
+        logger.error(f"Error saving user data: {e}")
+        user_store.restore_pending(batch)
 
-def save_user_data(user_data):
-    """Save user data to JSON file"""
+async def periodic_user_flush():
+    """Flush user visits every USER_FLUSH_INTERVAL seconds or once a batch fills up"""
+    while True:
+        try:
+            await asyncio.wait_for(user_flush_wakeup.wait(), USER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        user_flush_wakeup.clear()
+        await flush_user_visits()
+        answer_log.flush()
+
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")  # Answer log of finished quizzes, read by analytics.py
+
+class AnswerLog:
+    """Append-only columnar log of finished quizzes, one raw array file per column
+
+    quizzes_user.q and quizzes_finished.d hold one row per quiz; answers_quiz.I,
+    answers_qid.I and answers_chosen.B one row per answer, quiz being the row
+    number in the quizzes columns and chosen the original answer index (0 is correct).
+    Every process writes its own directory, shards never share a file.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files = None
+        self.quizzes = 0
+
+    def _open(self):
+        directory = os.path.join(self.root, f"shard-{SHARD_INDEX}")
+        os.makedirs(directory, exist_ok=True)
+        self.files = {
+            f"{table}_{name}": open(os.path.join(directory, f"{table}_{name}.{code}"), "ab")
+            for table, columns in (("quizzes", analytics.QUIZ_COLUMNS), ("answers", analytics.ANSWER_COLUMNS))
+            for name, code in columns
+        }
+        # Continue numbering after the quizzes already in the log
+        self.quizzes = os.path.getsize(self.files["quizzes_user"].name) // 8
+
+    def append(self, session: Session):
+        answered = len(session.answers or ())
+        if not answered:
+            return
+        try:
+            if self.files is None:
+                self._open()
+            quiz = self.quizzes
+            self.quizzes += 1
+            # The quiz row goes first, so a crash never leaves answers without their quiz
+            self.files["quizzes_user"].write(array("q", (session.user_id,)).tobytes())
+            self.files["quizzes_finished"].write(array("d", (time.time(),)).tobytes())
+            self.files["answers_quiz"].write(array("I", (quiz,)).tobytes() * answered)
+            self.files["answers_qid"].write(session.quiz[:answered].tobytes())
+            self.files["answers_chosen"].write(bytes(session.answers))
+        except OSError as e:
+            logger.error(f"Error writing answer log: {e}")
+
+    def flush(self):
+        for f in (self.files or {}).values():
+            try:
+                f.flush()
+            except OSError as e:
+                logger.error(f"Error flushing answer log: {e}")
+
+answer_log = AnswerLog(ANALYTICS_DIR)
+
+# Adaptive question selection
+QUESTION_SELECTION = os.getenv("QUESTION_SELECTION", "uniform")  # "adaptive" favours hard and missed questions
+BASE_WEIGHT = 0.25  # Added to the error rate, so questions everybody gets right still come up
+SEEN_WEIGHT = 0.1  # Weight factor of questions the user has already answered right
+MISSED_WEIGHT = 3.0  # Weight factor of questions the user last answered wrong
+
+class WeightTree:
+    """Fenwick tree over non-negative weights: O(log n) weight updates and weighted draws"""
+    __slots__ = ("weights", "tree", "total", "top")
+
+    def __init__(self, weights):
+        self.weights = array("d", weights)
+        self.top = 1 << (len(self.weights).bit_length() - 1) if self.weights else 0
+        self.rebuild()
+
+    def rebuild(self):
+        """Recompute every partial sum, dropping accumulated rounding"""
+        n = len(self.weights)
+        tree = array("d", bytes(8)) + self.weights
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.total = math.fsum(self.weights)
+
+    def update(self, index: int, weight: float):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self.total += delta
+        tree = self.tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def find(self, x: float) -> int:
+        """Index whose slice of the cumulative weight contains x"""
+        tree = self.tree
+        pos = 0
+        step = self.top
+        while step:
+            if pos + step < len(tree) and tree[pos + step] <= x:
+                pos += step
+                x -= tree[pos]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+class QuestionStats:
+    """Per-question answer counts of the current bank, kept current by store_answer
+
+    Every pool gets a WeightTree of difficulty weights the first time a quiz is
+    drawn from it, and each answer updates its question's weight in place.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.shown = array("I")
+        self.wrong = array("I")
+        self.trees = {}  # Pool start -> WeightTree
+        self.pool_starts = []
+
+    def _reset(self, bank: QuestionBank):
+        self.version = bank.version
+        self.shown = array("I", bytes(4 * len(bank)))
+        self.wrong = array("I", bytes(4 * len(bank)))
+        self.trees = {}
+        self.pool_starts = sorted(pool.start for levels in bank.levels.values() for pool in levels.values())
+
+    def weight(self, qid: int) -> float:
+        # Error rate smoothed towards 1/2, so a few answers do not decide a question
+        return BASE_WEIGHT + (self.wrong[qid] + 1) / (self.shown[qid] + 2)
+
+    def _follow(self, bank: QuestionBank) -> bool:
+        """Switch to the current bank; False for a bank that was already replaced"""
+        if bank.version != self.version:
+            if bank is not question_bank:
+                return False
+            # Counts of the previous bank do not carry over, ids can point elsewhere
+            self._reset(bank)
+        return True
+
+    def seed(self, bank: QuestionBank, root: str):
+        """Start from the counts in the answer log"""
+        self._reset(bank)
+        _, answers = analytics.load_log(root)
+        shown, wrong = analytics.answer_counts(answers, len(bank))
+        self.shown = array("I", shown.astype("<u4").tobytes())
+        self.wrong = array("I", wrong.astype("<u4").tobytes())
+        logger.info(f"Seeded question stats from {int(shown.sum())} logged answers")
+
+    def record(self, bank: QuestionBank, qid: int, wrong: bool):
+        if not self._follow(bank):
+            return
+        self.shown[qid] += 1
+        self.wrong[qid] += wrong
+        start = self.pool_starts[bisect.bisect_right(self.pool_starts, qid) - 1]
+        tree = self.trees.get(start)
+        if tree is not None:
+            tree.update(qid - start, self.weight(qid))
+
+    def draw(self, bank: QuestionBank, pool: range, count: int, seen: array, missed: array) -> array:
+        """count distinct ids of pool, weighted by difficulty and the user's history (ascending ids)"""
+        if not self._follow(bank):
+            return array("I", random.sample(pool, count))
+        tree = self.trees.get(pool.start)
+        if tree is None:
+            tree = self.trees[pool.start] = WeightTree(self.weight(qid) for qid in pool)
+
+        # The user's history and the questions already drawn only change the
+        # tree until this returns; nothing else runs in between
+        changed = []
+        missed = set(missed)
+        for qid in seen[bisect.bisect_left(seen, pool.start):bisect.bisect_left(seen, pool.stop)]:
+            index = qid - pool.start
+            changed.append((index, tree.weights[index]))
+            tree.update(index, tree.weights[index] * (MISSED_WEIGHT if qid in missed else SEEN_WEIGHT))
+        quiz = array("I")
+        try:
+            while len(quiz) < count:
+                index = tree.find(random.random() * tree.total)
+                if tree.weights[index] == 0.0:
+                    # Rounding landed on a question that was already drawn
+                    tree.rebuild()
+                    continue
+                quiz.append(pool.start + index)
+                changed.append((index, tree.weights[index]))
+                tree.update(index, 0.0)
+        finally:
+            # Undo in reverse, so each weight ends at its value from before the draw
+            for index, weight in reversed(changed):
+                tree.update(index, weight)
+        return quiz
+
+question_stats = QuestionStats()
+
+# Per-user answer history
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
+
+def encode_ids(ids) -> bytes:
+    """Ascending question ids as varint gaps, about one byte per id in a dense pool"""
+    out = bytearray()
+    previous = 0
+    for qid in ids:
+        gap = qid - previous
+        previous = qid
+        while gap >= 0x80:
+            out.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+def decode_ids(blob: bytes) -> array:
+    ids = array("I")
+    previous = value = shift = 0
+    for byte in blob:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += value
+            ids.append(previous)
+            value = shift = 0
+    return ids
+
+class HistoryStore:
+    """Answer history of every user in one SQLite row: attempt counters, seen and missed questions
+
+    Seen holds every question the user answered, missed those whose latest answer
+    was wrong, both as encode_ids blobs. They belong to the bank version stored
+    with them and start over when the questions change, ids can point elsewhere.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")  # Shard workers share the file
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                user_id INTEGER PRIMARY KEY,
+                version BLOB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                answered INTEGER NOT NULL DEFAULT 0,
+                correct INTEGER NOT NULL DEFAULT 0,
+                seen BLOB NOT NULL,
+                missed BLOB NOT NULL,
+                last_attempt REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def _sets(self, user_id: int, version: bytes) -> Optional[tuple]:
+        row = self.conn.execute("SELECT version, seen, missed FROM history WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[0] != version:
+            return None
+        return decode_ids(row[1]), decode_ids(row[2])
+
+    def get(self, user_id: int, version: str) -> tuple:
+        """Ascending ids of the questions a user has seen and of those last answered wrong"""
+        with self.lock:
+            sets = self._sets(user_id, bytes.fromhex(version))
+        return sets if sets is not None else (array("I"), array("I"))
+
+    def record(self, user_id: int, version: str, quiz, answers: bytes):
+        """Fold one finished attempt into the user's history"""
+        version = bytes.fromhex(version)
+        with self.lock, self.conn:
+            sets = self._sets(user_id, version)
+            seen, missed = (set(sets[0]), set(sets[1])) if sets is not None else (set(), set())
+            for qid, chosen in zip(quiz, answers):
+                seen.add(qid)
+                if chosen:
+                    missed.add(qid)
+                else:
+                    missed.discard(qid)
+            self.conn.execute("""
+                INSERT INTO history (user_id, version, attempts, answered, correct, seen, missed, last_attempt)
+                VALUES (?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    version = excluded.version,
+                    attempts = history.attempts + 1,
+                    answered = history.answered + excluded.answered,
+                    correct = history.correct + excluded.correct,
+                    seen = excluded.seen,
+                    missed = excluded.missed,
+                    last_attempt = excluded.last_attempt
+            """, (user_id, version, len(answers), answers.count(0),
+                  encode_ids(sorted(seen)), encode_ids(sorted(missed)), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+history_store = HistoryStore(HISTORY_DB)
+
+async def record_history(session: Session):
+    """Fold a finished quiz into the user's history off the event loop"""
+    # Ids of a replaced bank would wipe a history already kept for the new one
+    if not session.answered or session.bank is not question_bank:
+        return
     try:
-        with open("users.json", "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        await run_in_user_store(
+            history_store.record, session.user_id, session.bank.version,
+            session.quiz[:session.answered], bytes(session.answers),
+        )
     except Exception as e:
-        logger.error(f"Error saving user data: {e}")
+        logger.error(f"Error saving history for user {session.user_id}: {e}")
 
+# User monitoring functions
 def add_user_info(user: types.User):
-    """Add or update user information"""
-    user_data = load_user_data()
-    
-    # Check if user already exists
-    existing_user = None
-    for i, u in enumerate(user_data["users"]):
-        if u["user_id"] == user.id:
-            existing_user = i
-            break
-    
+    """Add or update user information (persisted by the next write-behind flush)"""
+    now = datetime.now().isoformat()
     user_info = {
         "user_id": user.id,
         "first_name": user.first_name or "",
         "last_name": user.last_name or "",
         "username": user.username or "",
         "language_code": user.language_code or "",
-        "is_premium": getattr(user, 'is_premium', False),
-        "first_seen": datetime.now().isoformat() if existing_user is None else user_data["users"][existing_user]["first_seen"],
-        "last_seen": datetime.now().isoformat(),
-        "total_visits": user_data["users"][existing_user]["total_visits"] + 1 if existing_user is not None else 1
+        "is_premium": bool(getattr(user, 'is_premium', False)),
+        "first_seen": now,
+        "last_seen": now,
+        "total_visits": 1
     }
-    
-    if existing_user is not None:
-        user_data["users"][existing_user] = user_info
-    else:
-        user_data["users"].append(user_info)
-        user_data["total_users"] = len(user_data["users"])
-    
-    save_user_data(user_data)
-    return user_info
 
+    user_info = user_store.buffer_visit(user_info)
+    if len(user_store.pending) >= USER_FLUSH_BATCH:
+        user_flush_wakeup.set()
+    return user_info
 class SessionManager:
     @staticmethod
     def cleanup_expired_sessions():
         """Remove expired sessions to free memory"""
         current_time = time.time()
-        expired_users = []
         
-        for user_id, session in user_sessions.items():
-            if current_time - session.get('last_activity', 0) > SESSION_TIMEOUT:
-                expired_users.append(user_id)
-        
-        for user_id in expired_users:
-            SessionManager.remove_session(user_id)
-            logger.info(f"Removed expired session for user {user_id}")
+        # Sessions are kept in activity order, so stop at the first live one
+        while user_sessions:
+            session = user_sessions.oldest()
+            if current_time - session.last_activity <= SESSION_TIMEOUT:
+                break
+            SessionManager.remove_session(session.user_id)
+            logger.info(f"Removed expired session for user {session.user_id}")
+    
+    @staticmethod
+    def add_session(session: Session):
+        """Store a new session as the most recently active one"""
+        user_sessions.add(session)
     
     @staticmethod
     def remove_session(user_id: int):
         """Safely remove a user session and cancel timers"""
-        # Cancel timer task if exists
-        if user_id in timer_tasks:
-            task = timer_tasks[user_id]
-            if not task.done():
-                task.cancel()
-            del timer_tasks[user_id]
+        # Cancel pending timer deadline
+        timer_wheel.cancel(user_id)
         
         # Remove session
-        if user_id in user_sessions:
-            del user_sessions[user_id]
-        
-        # Force garbage collection periodically
-        if len(user_sessions) % 100 == 0:
-            gc.collect()
-    
+        user_sessions.remove(user_id)
+            
     @staticmethod
     def update_activity(user_id: int):
         """Update last activity timestamp"""
-        if user_id in user_sessions:
-            user_sessions[user_id]['last_activity'] = time.time()
+        session = user_sessions.get(user_id)
+        if session is not None:
+            session.last_activity = time.time()
+            user_sessions.touch(user_id)
     
     @staticmethod
     def check_session_limit():
@@ -560,9 +1671,432 @@ class SessionManager:
             # Clean up old sessions
             SessionManager.cleanup_expired_sessions()
             if len(user_sessions) >= MAX_SESSIONS:
-                return False
+                # Make room by evicting the least recently active session
+                session = user_sessions.oldest()
+                if time.time() - session.last_activity < SESSION_EVICT_IDLE:
+                    return False
+                SessionManager.remove_session(session.user_id)
+                logger.info(f"Evicted idle session for user {session.user_id}")
         return True
 
+# Garbage collector policy: thresholds as "gen0,gen1,gen2", e.g. GC_THRESHOLDS=50000,20,100
+GC_THRESHOLDS = os.getenv("GC_THRESHOLDS", "")
+GC_FREEZE = os.getenv("GC_FREEZE", "1") == "1"  # Move startup objects out of collected generations
+
+class GCMonitor:
+    """Record collector pause times through gc.callbacks"""
+
+    def __init__(self):
+        self.started = 0.0
+        self.collections = [0, 0, 0]
+        self.total_pause = 0.0
+        self.max_pause = 0.0
+        self.last_pause = 0.0
+
+    def __call__(self, phase: str, info: dict):
+        if phase == "start":
+            self.started = time.perf_counter()
+            return
+        pause = time.perf_counter() - self.started
+        self.collections[info["generation"]] += 1
+        self.total_pause += pause
+        self.last_pause = pause
+        if pause > self.max_pause:
+            self.max_pause = pause
+
+    def summary(self) -> str:
+        count = sum(self.collections)
+        average = self.total_pause / count if count else 0.0
+        return (f"GC: {'/'.join(map(str, self.collections))} yig'ish, "
+                f"o'rtacha {average * 1000:.2f}ms, maks {self.max_pause * 1000:.2f}ms")
+
+gc_monitor = GCMonitor()
+
+def configure_gc():
+    """Apply the collector policy once startup data is loaded"""
+    if GC_THRESHOLDS:
+        try:
+            gc.set_threshold(*(int(value) for value in GC_THRESHOLDS.split(",")))
+        except (ValueError, TypeError) as e:
+            logger.error(f"Invalid GC_THRESHOLDS {GC_THRESHOLDS!r}: {e}")
+    if GC_FREEZE:
+        # The question bank and keyboards live forever, stop rescanning them
+        gc.collect()
+        gc.freeze()
+    if gc_monitor not in gc.callbacks:
+        gc.callbacks.append(gc_monitor)
+    logger.info(f"GC thresholds: {gc.get_threshold()}, frozen objects: {gc.get_freeze_count()}")
+
+def restore_sessions():
+    """Reload persisted sessions and re-arm the deadlines of running quizzes"""
+    sessions = user_sessions.load()
+    now = time.time()
+    for session in sessions:
+        if session.state == SessionState.IN_QUIZ:
+            timer_wheel.schedule(session.user_id, max(session.deadline - now, 0), quiz_timeout, session.chat_id, session.user_id)
+    if sessions:
+        logger.info(f"Restored {len(sessions)} sessions, {len(timer_wheel)} running quizzes")
+
+# Metrics served in Prometheus text format on METRICS_HOST:METRICS_PORT/metrics (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram in seconds"""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """Handler latency, Bot API and event loop metrics"""
+
+    def __init__(self):
+        self.handler_latency: Dict[str, Histogram] = {}
+        self.handler_errors: Dict[str, int] = {}
+        self.api_calls: Dict[str, int] = {}
+        self.api_errors: Dict[str, int] = {}
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+
+    def observe_handler(self, name: str, seconds: float):
+        histogram = self.handler_latency.get(name)
+        if histogram is None:
+            histogram = self.handler_latency[name] = Histogram()
+        histogram.observe(seconds)
+
+    def render(self) -> str:
+        """Prometheus text exposition of all metrics"""
+        lines = ["# TYPE quizbot_handler_seconds histogram"]
+        for name, histogram in sorted(self.handler_latency.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'quizbot_handler_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'quizbot_handler_seconds_bucket{{handler="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'quizbot_handler_seconds_sum{{handler="{name}"}} {histogram.total:.6f}')
+            lines.append(f'quizbot_handler_seconds_count{{handler="{name}"}} {histogram.count}')
+        for metric, values, label in (
+            ("quizbot_handler_errors_total", self.handler_errors, "handler"),
+            ("quizbot_api_calls_total", self.api_calls, "method"),
+            ("quizbot_api_errors_total", self.api_errors, "method"),
+        ):
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{{label}="{key}"}} {value}' for key, value in sorted(values.items()))
+        for metric, value in (
+            ("quizbot_sessions", len(user_sessions)),
+            ("quizbot_timers", len(timer_wheel)),
+            ("quizbot_pending_user_writes", len(user_store.pending)),
+            ("quizbot_loop_lag_seconds", self.loop_lag),
+            ("quizbot_loop_lag_max_seconds", self.max_loop_lag),
+            ("quizbot_gc_pause_seconds_total", gc_monitor.total_pause),
+            ("quizbot_api_retries", outbound_limiter.retries),
+            ("quizbot_keyboard_cache_entries", len(keyboard_cache)),
+            ("quizbot_keyboard_cache_hits", keyboard_cache.hits),
+            ("quizbot_keyboard_cache_misses", keyboard_cache.misses),
+            ("quizbot_user_locks", len(user_locks.locks)),
+            ("quizbot_callbacks_debounced", user_locks.debounced),
+        ):
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = [f"Loop kechikishi: {self.loop_lag * 1000:.1f}ms (maks {self.max_loop_lag * 1000:.1f}ms)"]
+        lines.append(f"API so'rovlar: {sum(self.api_calls.values())}, xatolar: {sum(self.api_errors.values())}, "
+                     f"qayta urinishlar: {outbound_limiter.retries}")
+        lines.append(f"Klaviatura keshi: {len(keyboard_cache)} ta, "
+                     f"{keyboard_cache.hits} topildi / {keyboard_cache.misses} yaratildi")
+        for name, histogram in sorted(self.handler_latency.items()):
+            lines.append(f"{name}: {histogram.count}x, p50 ≤{histogram.quantile(0.5) * 1000:g}ms, "
+                         f"p99 ≤{histogram.quantile(0.99) * 1000:g}ms")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Time every message and callback handler by its function name"""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors[name] = metrics.handler_errors.get(name, 0) + 1
+            raise
+        finally:
+            metrics.observe_handler(name, time.perf_counter() - started)
+
+async def api_metrics_middleware(make_request, bot, method):
+    """Count outgoing Bot API calls and failures per method"""
+    name = type(method).__name__
+    metrics.api_calls[name] = metrics.api_calls.get(name, 0) + 1
+    try:
+        return await make_request(bot, method)
+    except Exception:
+        metrics.api_errors[name] = metrics.api_errors.get(name, 0) + 1
+        raise
+
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Measure how late the event loop wakes up a sleeping task"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.loop_lag = max(time.perf_counter() - started - interval, 0.0)
+        metrics.max_loop_lag = max(metrics.max_loop_lag, metrics.loop_lag)
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# Answer buttons carry everything needed to grade them: question id, position in
+# the quiz, permutation and pressed button, signed so they cannot be forged
+CALLBACK_SECRET = (os.getenv("CALLBACK_SECRET", "").encode()
+                   or hashlib.sha256(API_TOKEN.encode()).digest())  # Stable across restarts
+
+def _answer_tag(payload: str) -> str:
+    return hashlib.blake2b(payload.encode(), key=CALLBACK_SECRET[:64], digest_size=6).hexdigest()
+
+def encode_answer(qid: int, index: int, perm: int, button: int) -> str:
+    """Build answer callback_data, e.g. "a:812:3:17:2:1f0c9ab34e21" (well under 64 bytes)"""
+    payload = f"a:{qid}:{index}:{perm}:{button}"
+    return f"{payload}:{_answer_tag(payload)}"
+
+def decode_answer(data: str) -> Optional[tuple]:
+    """Return (qid, index, perm, button), or None if the data is malformed or forged"""
+    payload, _, tag = data.rpartition(":")
+    if not hmac.compare_digest(tag, _answer_tag(payload)):
+        return None
+    try:
+        qid, index, perm, button = map(int, payload.split(":")[1:])
+    except ValueError:
+        return None
+    if not (0 <= perm < len(PERMUTATIONS) and 0 <= button < len(ANSWER_KEYS)):
+        return None
+    return qid, index, perm, button
+
+# Answer keyboards are static per (question, position, permutation) and are built once
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "5000"))  # About 5.5 KB per entry, ~27 MB at the cap
+CANCEL_BUTTON_ROW = [InlineKeyboardButton(text="❌ Testni bekor qilish", callback_data="cancel_test")]
+
+class KeyboardCache:
+    """LRU cache of answer keyboards keyed by (bank version, question id, position, permutation)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, version: str, q: Question, index: int, perm: int) -> InlineKeyboardMarkup:
+        key = (version, q.id, index, perm)
+        keyboard = self.entries.get(key)
+        if keyboard is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return keyboard
+
+        self.misses += 1
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=q.answers[answer], callback_data=encode_answer(q.id, index, perm, i))]
+            for i, answer in enumerate(PERMUTATIONS[perm])
+        ] + [CANCEL_BUTTON_ROW])
+        self.entries[key] = keyboard
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return keyboard
+
+keyboard_cache = KeyboardCache(KEYBOARD_CACHE_SIZE)
+
+# Update the question message in place instead of deleting it and sending a new one
+EDIT_IN_PLACE = os.getenv("EDIT_IN_PLACE", "1") == "1"
+
+async def show_message(chat_id: int, message_id: Optional[int], text: str, reply_markup=None) -> int:
+    """Edit the given message, or send a new one if there is none or editing fails"""
+    if EDIT_IN_PLACE and message_id:
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+            return message_id
+        except TelegramBadRequest as e:
+            # Too old, deleted or otherwise not editable
+            logger.info(f"Cannot edit message {message_id} in chat {chat_id}, sending a new one: {e}")
+    message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
+    return message.message_id
+
+# Outgoing Bot API limits (Telegram allows about 30 messages/s overall and 1/s per chat)
+GLOBAL_RATE = 30  # Messages per second across all chats
+GLOBAL_BURST = 30
+CHAT_RATE = 1  # Messages per second in a single chat
+CHAT_BURST = 5
+CHAT_BUCKETS_MAX = 10000  # Idle per-chat buckets beyond this are dropped
+API_RETRIES = 3
+# Methods that post or change chat messages and count towards flood limits
+RATE_LIMITED_METHODS = (methods.SendMessage, methods.SendDocument, methods.EditMessageText)
+
+class TokenBucket:
+    """Token bucket that makes callers wait for their turn"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Take a token and return how long to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        """Hold every caller back, used when Telegram asks us to retry later"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity and now >= self.blocked_until
+
+class OutboundLimiter:
+    """Request middleware applying global and per-chat rate limits with retries"""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.retries = 0
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+            if len(self.chat_buckets) > CHAT_BUCKETS_MAX:
+                # A bucket that refilled completely holds no state worth keeping
+                oldest_id, oldest = next(iter(self.chat_buckets.items()))
+                if oldest.idle():
+                    del self.chat_buckets[oldest_id]
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        limited = isinstance(method, RATE_LIMITED_METHODS)
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(API_RETRIES + 1):
+            if limited:
+                wait = self.global_bucket.delay()
+                if isinstance(chat_id, int):
+                    wait = max(wait, self.chat_bucket(chat_id).delay())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == API_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(f"Flood limit on {type(method).__name__}, retrying in {e.retry_after}s")
+                if isinstance(chat_id, int):
+                    self.chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == API_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(f"{type(method).__name__} failed ({e}), retrying")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+outbound_limiter = OutboundLimiter()
+
+# A repeated tap on the same button within this many seconds is dropped (0 disables)
+CALLBACK_DEBOUNCE = float(os.getenv("CALLBACK_DEBOUNCE", "1.0"))
+
+class UserLockMiddleware(BaseMiddleware):
+    """Handle one update per user at a time and drop repeated taps on the same button"""
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        # A lock exists only while some update of its user holds or awaits it
+        self.locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+        # user_id -> (message_id, data, monotonic time) of the last tap, oldest first
+        self.taps: "OrderedDict[int, tuple]" = OrderedDict()
+        self.debounced = 0
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        return lock
+
+    def is_repeat(self, user_id: int, callback: CallbackQuery) -> bool:
+        now = time.monotonic()
+        while self.taps and now - next(iter(self.taps.values()))[2] >= self.debounce:
+            self.taps.popitem(last=False)
+        # The message is edited in place, so its id alone does not identify a question
+        tap = (callback.message.message_id if callback.message else None, callback.data)
+        previous = self.taps.pop(user_id, None)
+        self.taps[user_id] = tap + (now,)
+        return previous is not None and previous[:2] == tap
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        if self.debounce and isinstance(event, CallbackQuery) and self.is_repeat(user.id, event):
+            self.debounced += 1
+            await event.answer()
+            return None
+        async with self.lock(user.id):
+            return await handler(event, data)
+
+user_locks = UserLockMiddleware(CALLBACK_DEBOUNCE)
+# Outer middlewares, so filters that read the session run under the lock too
+dp.message.outer_middleware(user_locks)
+dp.callback_query.outer_middleware(user_locks)
+
 # Periodic cleanup task
 async def periodic_cleanup():
     """Run cleanup every 10 minutes"""
@@ -570,7 +2104,7 @@ async def periodic_cleanup():
         try:
             await asyncio.sleep(600)  # 10 minutes
             SessionManager.cleanup_expired_sessions()
-            logger.info(f"Active sessions: {len(user_sessions)}, Active timers: {len(timer_tasks)}")
+            logger.info(f"Active sessions: {len(user_sessions)}, Active timers: {len(timer_wheel)}")
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
 
@@ -595,15 +2129,10 @@ async def start_quiz(message: Message):
     # Clean up any existing session for this user
     SessionManager.remove_session(message.from_user.id)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=cat["category"], callback_data=f"cat_{cat['category']}")]
-        for cat in data["categories"]
-    ])
-    
     welcome_text = f"Assalomu alaykum {message.from_user.first_name}! 👋\n\n  Yordam uchun Jo'nating - /help \n\n"
     welcome_text += "📚 Test kategoriyasini tanlang:"
     
-    await message.answer(welcome_text, reply_markup=keyboard)
+    await message.answer(welcome_text, reply_markup=question_bank.category_keyboard)
 
 # Category chosen
 @dp.callback_query(F.data.startswith("cat_"))
@@ -613,47 +2142,65 @@ async def choose_difficulty(callback: CallbackQuery):
         return
     
     category = callback.data.split("_", 1)[1]
-    user_sessions[callback.from_user.id] = {
-        "category": category,
-        "last_activity": time.time()
-    }
+    keyboard = question_bank.difficulty_keyboards.get(category)
+    if keyboard is None:
+        await callback.answer("❌ Kategoriya yoki daraja topilmadi. Qaytadan boshlang.")
+        return
+
+    session = Session(callback.from_user.id, callback.message.chat.id)
+    session.category = category
+    session.state = SessionState.CHOOSING_DIFFICULTY
+    SessionManager.add_session(session)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"{level}-daraja", callback_data=f"diff_{level}")]
-        for level in ["1", "2", "3"]
-    ])
     await callback.message.answer(f"⚡ Kategoriya: {category}\nQiyinlik darajasini tanlang:", reply_markup=keyboard)
     await callback.answer()
 
 # Difficulty chosen
 @dp.callback_query(F.data.startswith("diff_"))
 async def choose_count(callback: CallbackQuery):
-    if callback.from_user.id not in user_sessions:
+    session = user_sessions.get(callback.from_user.id)
+    if session is None:
         await callback.answer("❌ Sessiya tugagan. /start buyrug'i bilan qaytadan boshlang")
         return
+    if session.state == SessionState.IN_QUIZ:
+        await callback.answer()
+        return
     
     SessionManager.update_activity(callback.from_user.id)
     
     level = callback.data.split("_")[1]
-    user_sessions[callback.from_user.id]["difficulty"] = level
-
-    category = user_sessions[callback.from_user.id]["category"]
-    try:
-        category_data = next(cat for cat in data["categories"] if cat["category"] == category)
-        questions = category_data["difficulty_levels"][level]
-    except (KeyError, StopIteration):
+    questions = session.bank.pool(session.category, level)
+    if questions is None:
         await callback.answer("❌ Kategoriya yoki daraja topilmadi. Qaytadan boshlang.")
         SessionManager.remove_session(callback.from_user.id)
         return
 
-    user_sessions[callback.from_user.id]["questions_pool"] = questions
+    session.difficulty = level
+    session.questions_pool = questions
+    session.state = SessionState.AWAITING_COUNT
+    user_sessions.save(session)
 
     await callback.message.answer(f"📊 Mavjud savollar soni: {len(questions)}\nNechta savol yechmoqchisiz? (raqam kiriting)")
     await callback.answer()
 
+# Text input is routed by session state: one dict lookup plus one attribute read
+def session_input_filter(message: Message):
+    session = user_sessions.get(message.from_user.id)
+    if session is not None and session.state in SESSION_INPUT_HANDLERS:
+        return {"session": session}
+    return False
+
+@dp.message(session_input_filter)
+async def handle_session_input(message: Message, session: Session):
+    handler = SESSION_INPUT_HANDLERS[session.state]
+    started = time.perf_counter()
+    try:
+        await handler(message, session)
+    finally:
+        metrics.observe_handler(handler.__name__, time.perf_counter() - started)
+
 # Number of questions
-@dp.message(lambda message: message.from_user.id in user_sessions and "questions_pool" in user_sessions[message.from_user.id] and "count" not in user_sessions[message.from_user.id])
-async def set_question_count(message: Message):
+async def set_question_count(message: Message, session: Session):
     if not await check_user_limit(message.from_user.id):
         return
     
@@ -662,17 +2209,17 @@ async def set_question_count(message: Message):
     except:
         return await message.answer("❌ Iltimos, raqam kiriting")
 
-    session = user_sessions[message.from_user.id]
-    total_available = len(session["questions_pool"])
+    total_available = len(session.questions_pool)
     if count < 1 or count > total_available:
         return await message.answer(f"❌ {1} dan {total_available} gacha raqam kiriting")
 
-    session["count"] = count
+    session.count = count
+    session.state = SessionState.AWAITING_TIMER
+    user_sessions.save(session)
     await message.answer("⏳ Test uchun necha daqiqa vaqt ajratasiz? (raqam kiriting)")
 
 # Timer
-@dp.message(lambda message: message.from_user.id in user_sessions and "count" in user_sessions[message.from_user.id] and "timer" not in user_sessions[message.from_user.id])
-async def set_timer(message: Message):
+async def set_timer(message: Message, session: Session):
     if not await check_user_limit(message.from_user.id):
         return
     
@@ -683,44 +2230,40 @@ async def set_timer(message: Message):
     except:
         return await message.answer("❌ Iltimos, raqam kiriting")
 
-    session = user_sessions[message.from_user.id]
-    session.update({
-        "timer": minutes * 60,
-        "score": 0,
-        "answered": 0,
-        "quiz": random.sample(session["questions_pool"], session["count"]),
-        "current_index": 0,
-        "answers": [],
-        "start_time": time.time(),
-        "last_activity": time.time()
-    })
+    session.timer = minutes * 60
+    session.score = 0
+    session.answered = 0
+    if QUESTION_SELECTION == "adaptive" and isinstance(session.questions_pool, range):
+        seen, missed = await run_in_user_store(history_store.get, session.user_id, session.bank.version)
+        session.quiz = question_stats.draw(session.bank, session.questions_pool, session.count, seen, missed)
+    else:
+        session.quiz = array("I", random.sample(session.questions_pool, session.count))
+    session.current_index = 0
+    session.answers = bytearray()
+    session.start_time = time.time()
+    session.state = SessionState.IN_QUIZ
+    SessionManager.update_activity(session.user_id)
 
     await message.answer(f"✅ Test boshlandi!\n⏳ Sizda {minutes} daqiqa vaqt bor.\nOmad yor bo'lsin! 🍀")
 
-    # Create and store timer task
-    timer_tasks[message.from_user.id] = asyncio.create_task(
-        run_timer(message.chat.id, message.from_user.id)
-    )
+    # Schedule the quiz deadline
+    timer_wheel.schedule(message.from_user.id, session.timer, quiz_timeout, message.chat.id, message.from_user.id)
     await send_question(message.chat.id, message.from_user.id)
 
-# Timer background task with error handling
-async def run_timer(chat_id, user_id):
+SESSION_INPUT_HANDLERS = {
+    SessionState.AWAITING_COUNT: set_question_count,
+    SessionState.AWAITING_TIMER: set_timer,
+}
+
+# Fired by the timer wheel when a quiz deadline passes
+async def quiz_timeout(chat_id, user_id):
     try:
-        if user_id not in user_sessions:
-            return
-        
-        await asyncio.sleep(user_sessions[user_id]["timer"])
-        
-        if user_id in user_sessions:  # session still active
-            await finish_quiz(chat_id, user_id, "⏰ Vaqt tugadi!")
-    except asyncio.CancelledError:
-        logger.info(f"Timer cancelled for user {user_id}")
+        # Not an update, so take the user's lock explicitly to not race a late answer
+        async with user_locks.lock(user_id):
+            if user_id in user_sessions:  # session still active
+                await finish_quiz(chat_id, user_id, "⏰ Vaqt tugadi!")
     except Exception as e:
         logger.error(f"Timer error for user {user_id}: {e}")
-    finally:
-        # Clean up timer task reference
-        if user_id in timer_tasks:
-            del timer_tasks[user_id]
 
 async def send_question(chat_id, user_id):
     if user_id not in user_sessions:
@@ -729,72 +2272,77 @@ async def send_question(chat_id, user_id):
     session = user_sessions[user_id]
     SessionManager.update_activity(user_id)
 
-    if session["current_index"] >= session["count"]:
+    if session.current_index >= session.count:
         await finish_quiz(chat_id, user_id, "🏁 Test yakunlandi!")
         return
 
-    q = session["quiz"][session["current_index"]]
-
-    answers = [q["true_answer"], q["answer_1"], q["answer_2"], q["answer_3"]]
-    random.shuffle(answers)
+    q = session.bank.questions[session.quiz[session.current_index]]
 
-    session["current_question"] = {
-        "question": q["question"],
-        "true_answer": q["true_answer"],
-        "answers": answers
-    }
+    # Shuffle answers by picking one of the precomputed permutations; the
+    # buttons carry it, so the session does not need to remember it
+    perm = random.randrange(len(PERMUTATIONS))
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=ans, callback_data=f"ans_{i}")]
-        for i, ans in enumerate(answers)
-    ] + [
-        [InlineKeyboardButton(text="❌ Testni bekor qilish", callback_data="cancel_test")]
-    ])
+    keyboard = keyboard_cache.get(session.bank.version, q, session.current_index, perm)
 
-    question_num = session["current_index"] + 1
-    total_questions = session["count"]
+    question_num = session.current_index + 1
+    total_questions = session.count
     
     try:
-        await bot.send_message(chat_id, f"❓ Savol {question_num}/{total_questions}:\n\n{q['question']}", reply_markup=keyboard)
-    except Exception as e:
+        session.message_id = await show_message(
+            chat_id, session.message_id, f"❓ Savol {question_num}/{total_questions}:\n\n{q.text}", keyboard
+        )
+        user_sessions.save(session)
+    except TelegramForbiddenError as e:
+        # The user blocked the bot, nobody is left to answer
         logger.error(f"Failed to send question to user {user_id}: {e}")
         SessionManager.remove_session(user_id)
+    except Exception as e:
+        # Retries are exhausted; keep the session so the deadline still reports results
+        logger.error(f"Failed to send question to user {user_id}: {e}")
 
 # Handle answers
-@dp.callback_query(F.data.startswith("ans_"))
+@dp.callback_query(F.data.startswith("a:"))
 async def store_answer(callback: CallbackQuery):
     user_id = callback.from_user.id
     
-    if user_id not in user_sessions:
+    session = user_sessions.get(user_id)
+    if session is None or session.state != SessionState.IN_QUIZ:
         await callback.answer("❌ Sessiya tugagan. /start buyrug'i bilan qaytadan boshlang")
         return
+
+    answer = decode_answer(callback.data)
+    if answer is None:
+        await callback.answer("❌ Noto'g'ri tugma")
+        return
+    qid, index, perm, button = answer
+    # Double taps and buttons of earlier questions no longer match the current position
+    if index != session.current_index or index >= session.count or session.quiz[index] != qid:
+        await callback.answer("⚠️ Bu savolga allaqachon javob berilgan")
+        return
     
     SessionManager.update_activity(user_id)
     
     try:
-        index = int(callback.data.split("_")[1])
-        session = user_sessions[user_id]
-        q = session["current_question"]
-
-        chosen = q["answers"][index]
-        correct = q["true_answer"]
-
-        session["answers"].append({
-            "question": q["question"],
-            "chosen": chosen,
-            "correct": correct,
-            "is_correct": chosen == correct
-        })
-
-        if chosen == correct:
-            session["score"] += 1
-
-        session["answered"] += 1
-        session["current_index"] += 1
-
-        await callback.message.delete()
-        await send_question(callback.message.chat.id, user_id)
-        await callback.answer()
+        # Map the pressed button back to the original answer index, 0 is correct
+        chosen = PERMUTATIONS[perm][button]
+        session.answers.append(chosen)
+        if QUESTION_SELECTION == "adaptive":
+            question_stats.record(session.bank, qid, chosen != 0)
+
+        if chosen == 0:
+            session.score += 1
+
+        session.answered += 1
+        session.current_index += 1
+
+        # Acknowledge and render the next question concurrently
+        calls = [bot(callback.answer()), send_question(callback.message.chat.id, user_id)]
+        if not EDIT_IN_PLACE:
+            calls.append(bot(callback.message.delete()))
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error processing answer for user {user_id}: {result}")
         
     except Exception as e:
         logger.error(f"Error processing answer for user {user_id}: {e}")
@@ -808,37 +2356,42 @@ async def cancel_test(callback: CallbackQuery):
 
 # End quiz and show results
 async def finish_quiz(chat_id, user_id, reason):
-    if user_id not in user_sessions:
+    session = user_sessions.get(user_id)
+    if session is None or session.state != SessionState.IN_QUIZ:
+        SessionManager.remove_session(user_id)
         return
     
+    started = time.perf_counter()
     try:
-        session = user_sessions[user_id]
-        
         # Calculate time spent
         end_time = time.time()
-        time_spent = end_time - session["start_time"]
+        time_spent = end_time - session.start_time
         minutes_spent = int(time_spent // 60)
         seconds_spent = int(time_spent % 60)
 
         # Create results message
-        percentage = (session["score"] / session["answered"] * 100) if session["answered"] > 0 else 0
+        percentage = (session.score / session.answered * 100) if session.answered > 0 else 0
         
         result_text = f"{reason}\n\n📊 **Natijalar:**\n"
-        result_text += f"✅ To'g'ri javoblar: {session['score']}/{session['answered']} ({percentage:.1f}%)\n"
+        result_text += f"✅ To'g'ri javoblar: {session.score}/{session.answered} ({percentage:.1f}%)\n"
         result_text += f"⏱ Sarflangan vaqt: {minutes_spent}d {seconds_spent}s\n\n"
 
         # Show wrong answers
-        wrong_answers = [ans for ans in session["answers"] if not ans["is_correct"]]
+        wrong_answers = [
+            (session.bank.questions[qid], chosen)
+            for qid, chosen in zip(session.quiz, session.answers)
+            if chosen != 0
+        ]
         
         if wrong_answers:
             result_text += "❌ **Noto'g'ri javoblar:**\n\n"
-            for i, wrong in enumerate(wrong_answers, 1):
+            for i, (q, chosen) in enumerate(wrong_answers, 1):
                 if len(result_text) > 3500:  # Prevent message from being too long
                     result_text += f"... va yana {len(wrong_answers) - i + 1}ta noto'g'ri javob"
                     break
-                result_text += f"{i}. **S:** {wrong['question'][:100]}{'...' if len(wrong['question']) > 100 else ''}\n"
-                result_text += f"   Sizning javobingiz: ❌ {wrong['chosen']}\n"
-                result_text += f"   To'g'ri javob: ✅ {wrong['correct']}\n\n"
+                result_text += f"{i}. **S:** {q.text[:100]}{'...' if len(q.text) > 100 else ''}\n"
+                result_text += f"   Sizning javobingiz: ❌ {q.answers[chosen]}\n"
+                result_text += f"   To'g'ri javob: ✅ {q.answers[0]}\n\n"
         else:
             result_text += "🎉 Ajoyib! Barcha javoblar to'g'ri!\n"
 
@@ -846,9 +2399,17 @@ async def finish_quiz(chat_id, user_id, reason):
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Boshqa test yechish", callback_data="restart")]
         ])
+        if wrong_answers:
+            keyboard.inline_keyboard.append(
+                [InlineKeyboardButton(text="🔁 Xatolarni qayta yechish", callback_data="mistakes")]
+            )
         
-        await bot.send_message(chat_id, result_text, reply_markup=keyboard)
-        logger.info(f"Quiz completed for user {user_id}: {session['score']}/{session['answered']}")
+        answer_log.append(session)
+        await record_history(session)
+
+        # Results replace the last question when editing in place
+        await show_message(chat_id, session.message_id, result_text, keyboard)
+        logger.info(f"Quiz completed for user {user_id}: {session.score}/{session.answered}")
         
     except Exception as e:
         logger.error(f"Error finishing quiz for user {user_id}: {e}")
@@ -856,6 +2417,7 @@ async def finish_quiz(chat_id, user_id, reason):
     finally:
         # Always clean up session
         SessionManager.remove_session(user_id)
+        metrics.observe_handler("finish_quiz", time.perf_counter() - started)
 
 # Restart handler
 @dp.callback_query(F.data == "restart")
@@ -863,43 +2425,69 @@ async def restart_quiz(callback: CallbackQuery):
     # Clean up any existing session
     SessionManager.remove_session(callback.from_user.id)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=cat["category"], callback_data=f"cat_{cat['category']}")]
-        for cat in data["categories"]
-    ])
-    await callback.message.answer("📚 Test kategoriyasini tanlang:", reply_markup=keyboard)
+    await callback.message.answer("📚 Test kategoriyasini tanlang:", reply_markup=question_bank.category_keyboard)
+    await callback.answer()
+
+# Retry my mistakes: a quiz over the questions the user last answered wrong
+async def start_mistakes(user_id: int, chat_id: int, reply):
+    if not await check_user_limit(user_id):
+        await reply("⚠️ Bot hozirda bandligi sababli, iltimos keyinroq urinib ko'ring.")
+        return
+
+    bank = question_bank
+    _, missed = await run_in_user_store(history_store.get, user_id, bank.version)
+    if not missed:
+        await reply("✅ Xato javob berilgan savollar yo'q. Yangi test uchun /start")
+        return
+
+    SessionManager.remove_session(user_id)
+    session = Session(user_id, chat_id)
+    session.bank = bank
+    session.questions_pool = missed
+    session.state = SessionState.AWAITING_COUNT
+    SessionManager.add_session(session)
+
+    await reply(f"🔁 Xato javob berilgan savollar soni: {len(missed)}\nNechta savol yechmoqchisiz? (raqam kiriting)")
+
+@dp.message(Command("mistakes"))
+async def retry_mistakes(message: Message):
+    await start_mistakes(message.from_user.id, message.chat.id, message.answer)
+
+@dp.callback_query(F.data == "mistakes")
+async def retry_mistakes_button(callback: CallbackQuery):
+    await start_mistakes(callback.from_user.id, callback.message.chat.id, callback.message.answer)
     await callback.answer()
 
 # Stats command for admin monitoring
 @dp.message(Command("stats"))
 async def show_stats(message: Message):
     if message.from_user.id == ADMIN_USER_ID:
-        user_data = load_user_data()
         stats_text = f"📊 **Bot Statistikasi:**\n"
         stats_text += f"Faol sessiyalar: {len(user_sessions)}\n"
-        stats_text += f"Faol taymerlar: {len(timer_tasks)}\n"
-        stats_text += f"Yuklangan kategoriyalar: {len(data.get('categories', []))}\n"
-        stats_text += f"Jami foydalanuvchilar: {user_data.get('total_users', 0)}\n"
-        stats_text += f"Bugungi yangi foydalanuvchilar: {len([u for u in user_data.get('users', []) if u.get('first_seen', '').startswith(datetime.now().strftime('%Y-%m-%d'))])}"
+        stats_text += f"Faol taymerlar: {len(timer_wheel)}\n"
+        stats_text += f"{gc_monitor.summary()}\n"
+        stats_text += f"{metrics.summary()}\n"
+        stats_text += f"Yuklangan kategoriyalar: {len(question_bank.categories)}\n"
+        stats_text += f"Savollar bazasi: {question_bank.version} ({len(question_bank)} ta savol, "
+        stats_text += f"{len(question_banks)} ta versiya ishlatilmoqda)\n"
+        total_users, new_users = await run_in_user_store(user_store.stats, datetime.now().strftime('%Y-%m-%d'))
+        stats_text += f"Jami foydalanuvchilar: {total_users}\n"
+        stats_text += f"Bugungi yangi foydalanuvchilar: {new_users}"
         await message.answer(stats_text)
 
 # User list command for admin
 @dp.message(Command("users"))
 async def show_users(message: Message):
     if message.from_user.id == ADMIN_USER_ID:
-        user_data = load_user_data()
-        users = user_data.get('users', [])
+        # Most recent users first, served by the last_seen index
+        users = await run_in_user_store(user_store.recent, 20)
         
         if not users:
             await message.answer("Hech qanday foydalanuvchi ma'lumoti topilmadi.")
             return
         
-        # Sort users by last seen (most recent first)
-        users.sort(key=lambda x: x.get('last_seen', ''), reverse=True)
-        
-        # Show last 20 users
         users_text = "👥 **So'nggi foydalanuvchilar:**\n\n"
-        for i, user in enumerate(users[:20], 1):
+        for i, user in enumerate(users, 1):
             name = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
             username = f"@{user.get('username')}" if user.get('username') else "Username yo'q"
             last_seen = user.get('last_seen', '')[:19] if user.get('last_seen') else 'Noma\'lum'
@@ -931,9 +2519,11 @@ async def show_users(message: Message):
 async def export_users(message: Message):
     if message.from_user.id == ADMIN_USER_ID:
         try:
-            # Send the users.json file
-            if os.path.exists("users.json"):
-                document = types.FSInputFile("users.json")
+            # Dump the user table to users.json and send it
+            await flush_user_visits()
+            await run_in_user_store(user_store.export_json, USERS_JSON)
+            if os.path.exists(USERS_JSON):
+                document = types.FSInputFile(USERS_JSON)
                 await message.answer_document(
                     document,
                     caption="📄 Foydalanuvchilar ma'lumotlari JSON formatida"
@@ -943,6 +2533,22 @@ async def export_users(message: Message):
         except Exception as e:
             await message.answer(f"Faylni yuborishda xatolik: {str(e)}")
 
+# Answer analytics for admin
+@dp.message(Command("analytics"))
+async def show_analytics(message: Message):
+    if message.from_user.id == ADMIN_USER_ID:
+        try:
+            answer_log.flush()
+            text, report = await asyncio.to_thread(analytics.run, ANALYTICS_DIR, question_bank)
+            await message.answer(text[:4000])
+            await message.answer_document(
+                types.BufferedInputFile(report, filename="analytics.csv"),
+                caption="📄 Savollar bo'yicha hisobot (CSV)"
+            )
+        except Exception as e:
+            logger.error(f"Analytics failed: {e}")
+            await message.answer(f"Tahlilda xatolik: {str(e)}")
+
 # Help command
 @dp.message(Command("help"))
 async def show_help(message: Message):
@@ -960,6 +2566,7 @@ Bu bot turli mavzularda test yechish uchun mo'ljallangan.
 
 ⚙️ **Buyruqlar:**
 /start - Botni qayta ishga tushirish
+/mistakes - Xato javob berilgan savollarni qayta yechish
 /help - Yordam
 """
     
@@ -969,18 +2576,357 @@ Bu bot turli mavzularda test yechish uchun mo'ljallangan.
 /stats - Bot statistikasi
 /users - Foydalanuvchilar ro'yxati
 /export - Foydalanuvchilar ma'lumotlarini yuklash
+/analytics - Savollar va natijalar tahlili
 """
     
     await message.answer(help_text)
 
-# Main function to run the bot
-async def main():
-    # Start cleanup task
+# Run mode: "polling" or "webhook", overridable with --mode
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")  # Address the aiohttp server binds to
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public base URL, registered with setWebhook when set
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Checked against X-Telegram-Bot-Api-Secret-Token
+DRAIN_TIMEOUT = 30  # Seconds to wait for in-flight handlers on shutdown
+
+class InFlightTracker(BaseMiddleware):
+    """Count updates being handled so shutdown can wait for them"""
+
+    def __init__(self):
+        self.count = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self.idle.set()
+
+    async def drain(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown with {self.count} updates still in flight")
+
+in_flight = InFlightTracker()
+dp.update.outer_middleware(in_flight)
+
+metrics_runner: Optional[web.AppRunner] = None
+
+async def on_startup():
+    global metrics_runner
+    configure_gc()
+    # The limiter wraps the metrics middleware, so every retry attempt is counted
+    if outbound_limiter not in bot.session.middleware:
+        bot.session.middleware(outbound_limiter)
+    if api_metrics_middleware not in bot.session.middleware:
+        bot.session.middleware(api_metrics_middleware)
+
+    # Start cleanup, user flush, timer and monitoring tasks
     asyncio.create_task(periodic_cleanup())
-    
-    # Start polling
+    asyncio.create_task(periodic_user_flush())
+    asyncio.create_task(monitor_loop_lag())
+    if QUESTIONS_RELOAD_INTERVAL > 0:
+        asyncio.create_task(watch_questions())
+    if QUESTION_SELECTION == "adaptive":
+        await asyncio.to_thread(question_stats.seed, question_bank, ANALYTICS_DIR)
+    timer_wheel.start()
+    restore_sessions()
+    metrics_runner = await start_metrics_server()
+
+async def on_shutdown():
+    await in_flight.drain(DRAIN_TIMEOUT)
+    timer_wheel.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    # Persist visits and answers that are still buffered
+    await flush_user_visits()
+    answer_log.flush()
+
+def create_webhook_app(handle_in_background: bool = True) -> web.Application:
+    """aiohttp application that feeds webhook updates to the dispatcher"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=handle_in_background,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    return app
+
+def stop_on_signals(signals=(signal.SIGINT, signal.SIGTERM)) -> asyncio.Event:
+    """Event set when one of the signals arrives"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    return stop
+
+async def set_webhook():
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+async def run_webhook():
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    await set_webhook()
+
+    stop = stop_on_signals()
+    try:
+        await stop.wait()
+    finally:
+        # Stop accepting updates first, then let running handlers finish
+        await site.stop()
+        await in_flight.drain(DRAIN_TIMEOUT)
+        await runner.cleanup()
+        await bot.session.close()
+
+# Sharded mode: a front process receives updates (polling or webhook) and routes
+# each one by user_id % BOT_SHARDS to a worker process over a Unix socket. A
+# worker owns the sessions and timers of its users and runs one user's updates
+# in arrival order, different users concurrently.
+BOT_SHARDS = int(os.getenv("BOT_SHARDS", "1"))  # Worker processes, 1 runs unsharded
+SHARD_FRAME = struct.Struct("<Iq")  # Payload length and user id before each raw update
+
+def update_user_id(update: dict) -> int:
+    """User an update belongs to, else its chat, else 0"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = event.get(field)
+            if isinstance(owner, dict) and "id" in owner:
+                return owner["id"]
+    return 0
+
+class ShardRouter:
+    """Front-process side of the shards: one ordered stream per worker"""
+
+    def __init__(self, paths: list):
+        self.paths = paths
+        self.writers = []
+
+    async def connect(self, timeout: float = 60):
+        """Connect to every worker, waiting for them to start listening"""
+        deadline = time.monotonic() + timeout
+        for path in self.paths:
+            while True:
+                try:
+                    _, writer = await asyncio.open_unix_connection(path)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() > deadline:
+                        raise
+                    await asyncio.sleep(0.1)
+            self.writers.append(writer)
+
+    async def route(self, payload: bytes, user_id: int):
+        writer = self.writers[user_id % len(self.writers)]
+        writer.write(SHARD_FRAME.pack(len(payload), user_id) + payload)
+        await writer.drain()
+
+    async def close(self):
+        """Closing the streams tells the workers to finish and exit"""
+        for writer in self.writers:
+            writer.close()
+        for writer in self.writers:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+class UserSerializer:
+    """Run each user's updates one after another, different users concurrently"""
+
+    def __init__(self):
+        self.tails: Dict[int, asyncio.Task] = {}  # Last queued update of each user
+
+    def __len__(self):
+        return len(self.tails)
+
+    def submit(self, user_id: int, coro) -> asyncio.Task:
+        task = asyncio.create_task(self._run(self.tails.get(user_id), coro))
+        self.tails[user_id] = task
+        task.add_done_callback(lambda done: self._release(user_id, done))
+        return task
+
+    async def _run(self, previous: Optional[asyncio.Task], coro):
+        if previous is not None:
+            await asyncio.wait((previous,))
+        return await coro
+
+    def _release(self, user_id: int, task: asyncio.Task):
+        if self.tails.get(user_id) is task:
+            del self.tails[user_id]
+
+    async def drain(self, timeout: float):
+        tasks = list(self.tails.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+shard_serializer = UserSerializer()
+
+async def feed_raw_update(payload: bytes):
+    try:
+        update = types.Update.model_validate_json(payload, context={"bot": bot})
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"Shard {SHARD_INDEX} failed to handle update: {e}")
+
+async def run_shard(path: str):
+    """Serve the front process on a Unix socket until it disconnects"""
+    await on_startup()
+    closed = stop_on_signals((signal.SIGTERM,))
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length, user_id = SHARD_FRAME.unpack(await reader.readexactly(SHARD_FRAME.size))
+                shard_serializer.submit(user_id, feed_raw_update(await reader.readexactly(length)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            closed.set()
+
+    server = await asyncio.start_unix_server(receive, path)
+    logger.info(f"Shard {SHARD_INDEX}/{SHARD_COUNT} listening on {path}")
+    try:
+        await closed.wait()
+    finally:
+        server.close()
+        await shard_serializer.drain(DRAIN_TIMEOUT)
+        await on_shutdown()
+        await bot.session.close()
+
+def run_shard_worker(index: int, count: int, path: str):
+    """Entry point of a worker process"""
+    global SHARD_INDEX, SHARD_COUNT, METRICS_PORT
+    SHARD_INDEX, SHARD_COUNT = index, count
+    if METRICS_PORT:
+        METRICS_PORT += index
+    # Ctrl+C reaches the whole process group; the front handles it and disconnects
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard(path))
+
+async def poll_to_shards(router: ShardRouter):
+    """Long-poll getUpdates and forward the raw updates without parsing them into models"""
+    await bot.delete_webhook()
+    url = bot.session.api.api_url(bot.token, "getUpdates")
+    params = {"offset": 0, "timeout": 30, "allowed_updates": dp.resolve_used_update_types()}
+    async with ClientSession(timeout=ClientTimeout(total=params["timeout"] + 10)) as http:
+        while True:
+            try:
+                async with http.post(url, json=params) as response:
+                    body = await response.json()
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not body.get("ok"):
+                logger.error(f"getUpdates failed: {body.get('description')}")
+                await asyncio.sleep(body.get("parameters", {}).get("retry_after", 1))
+                continue
+            for update in body["result"]:
+                params["offset"] = update["update_id"] + 1
+                await router.route(json.dumps(update).encode(), update_user_id(update))
+
+def create_shard_webhook_app(router: ShardRouter) -> web.Application:
+    """aiohttp application that forwards webhook updates to the shards unparsed"""
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        payload = await request.read()
+        try:
+            user_id = update_user_id(json.loads(payload))
+        except (ValueError, AttributeError):
+            return web.Response(status=400)
+        await router.route(payload, user_id)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    return app
+
+async def run_sharded(mode: str, shards: int):
+    """Front process: start the workers, then feed them updates until stopped"""
+    socket_dir = tempfile.mkdtemp(prefix="quizbot-shards-")
+    paths = [os.path.join(socket_dir, f"shard-{index}.sock") for index in range(shards)]
+    # Spawned workers import the bot afresh instead of inheriting this process' loop
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_shard_worker, args=(index, shards, path), name=f"shard-{index}")
+        for index, path in enumerate(paths)
+    ]
+    for worker in workers:
+        worker.start()
+
+    router = ShardRouter(paths)
+    stop = stop_on_signals()
+    try:
+        await router.connect()
+        logger.info(f"Routing updates to {shards} shards")
+        if mode == "webhook":
+            runner = web.AppRunner(create_shard_webhook_app(router))
+            await runner.setup()
+            site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+            await site.start()
+            await set_webhook()
+            try:
+                await stop.wait()
+            finally:
+                await site.stop()
+                await runner.cleanup()
+        else:
+            poller = asyncio.create_task(poll_to_shards(router))
+            stopped = asyncio.create_task(stop.wait())
+            await asyncio.wait((poller, stopped), return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if poller.done():
+                poller.result()  # The poller only ends by raising
+            poller.cancel()
+    finally:
+        await router.close()
+        for worker in workers:
+            await asyncio.to_thread(worker.join, DRAIN_TIMEOUT + 10)
+        shutil.rmtree(socket_dir, ignore_errors=True)
+        await bot.session.close()
+
+# Main function to run the bot
+async def main(mode: str = BOT_MODE):
+    await on_startup()
     logger.info("Bot ishga tushdi...")
-    await dp.start_polling(bot)
+    try:
+        if mode == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Quiz bot")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default=BOT_MODE)
+    parser.add_argument("--shards", type=int, default=BOT_SHARDS, help="worker processes, users split by user_id")
+    args = parser.parse_args()
+    if args.shards > 1:
+        asyncio.run(run_sharded(args.mode, args.shards))
+    else:
+        asyncio.run(main(args.mode))
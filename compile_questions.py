@@ -0,0 +1,69 @@
+# Compile questions.json into the binary bank the bot maps at startup
+#
+#   python compile_questions.py                   # questions.json -> questions.bin
+#   python compile_questions.py --input big.json --output big.bin
+#
+# questions.json stays the source of truth: the output records the hash of the
+# JSON it was built from, and the bot ignores it once the JSON changes. Rerun
+# this after every edit of the questions.
+
+import argparse
+import os
+import sys
+
+import bot as quizbot
+
+class StringTable:
+    """UTF-8 strings stored once each, addressed by (offset, length)"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.refs = {}
+
+    def add(self, text: str) -> tuple:
+        ref = self.refs.get(text)
+        if ref is None:
+            encoded = text.encode("utf-8")
+            ref = self.refs[text] = (len(self.data), len(encoded))
+            self.data += encoded
+        return ref
+
+def compile_bank(bank: quizbot.QuestionBank) -> bytes:
+    strings = StringTable()
+    level_table = bytearray()
+    level_count = 0
+    for category, levels in bank.levels.items():
+        for level, ids in levels.items():
+            level_table += quizbot.COMPILED_LEVEL.pack(*strings.add(category), *strings.add(level), ids.start, ids.stop)
+            level_count += 1
+
+    records = bytearray()
+    for qid in range(len(bank)):
+        q = bank.questions[qid]
+        refs = [strings.add(text) for text in (q.text,) + q.answers]
+        records += quizbot.COMPILED_QUESTION.pack(*(value for ref in refs for value in ref))
+
+    if len(strings.data) >= 2 ** 32:
+        raise ValueError("string table exceeds 4 GiB")
+    header = quizbot.COMPILED_HEADER.pack(
+        quizbot.COMPILED_MAGIC, 1, bytes.fromhex(bank.version), level_count, len(bank)
+    )
+    return bytes(header + level_table + records + strings.data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the question bank")
+    parser.add_argument("--input", default=quizbot.QUESTIONS_PATH)
+    parser.add_argument("--output", default=quizbot.QUESTIONS_COMPILED_PATH)
+    args = parser.parse_args()
+
+    # Always index the JSON itself, never an older compiled output
+    bank = quizbot.QuestionBank.load(args.input, args.input + ".idx")
+    compiled = compile_bank(bank)
+    with open(args.output + ".tmp", "wb") as f:
+        f.write(compiled)
+    os.replace(args.output + ".tmp", args.output)
+    print(f"{args.output}: {len(bank)} questions, {len(bank.categories)} categories, "
+          f"{len(compiled)} bytes, source {bank.version}")
+
+if __name__ == "__main__":
+    sys.exit(main())
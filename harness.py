@@ -0,0 +1,184 @@
+# Local test harness: drives the bot with synthetic updates, no network needed
+#
+#   python harness.py --users 200 --answers 10
+#
+# Starts the webhook server on localhost with a fake Bot API session and POSTs
+# complete quiz flows as Telegram Update JSON, then reports the throughput.
+
+import argparse
+import asyncio
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Union, get_args, get_origin
+
+# Keep the harness away from the real user and session databases
+_tmp = tempfile.mkdtemp(prefix="quizbot-harness-")
+atexit.register(shutil.rmtree, _tmp, True)
+os.environ.setdefault("USERS_DB", os.path.join(_tmp, "users.db"))
+os.environ.setdefault("SESSIONS_DB", os.path.join(_tmp, "sessions.db"))
+os.environ.setdefault("ANALYTICS_DIR", os.path.join(_tmp, "analytics"))
+os.environ.setdefault("HISTORY_DB", os.path.join(_tmp, "history.db"))
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+from aiohttp import ClientSession, web
+
+import bot as quizbot
+
+class FakeSession(BaseSession):
+    """Bot API session that answers every call locally"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self.message_id = 0
+        self.keyboards = {}  # chat_id -> last inline keyboard shown
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if getattr(method, "reply_markup", None) is not None:
+            self.keyboards[method.chat_id] = method.reply_markup
+        returning = method.__returning__
+        if returning is Message or (get_origin(returning) is Union and Message in get_args(returning)):
+            self.message_id += 1
+            return Message(
+                message_id=self.message_id,
+                date=datetime.now(),
+                chat=Chat(id=getattr(method, "chat_id", 0) or 0, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+class UpdateFactory:
+    """Build Telegram Update JSON for synthetic users"""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "uz"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def message(self, user_id: int, text: str) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, "message": self._message(user_id, text)}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        self.update_id += 1
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "message": self._message(user_id, "quiz"),
+                "data": data,
+            },
+        }
+
+    def flow(self, user_id: int, answers: int, minutes: int = 10):
+        """Updates of a complete quiz: /start, category, level, count, timer, answers"""
+        category = quizbot.question_bank.categories[user_id % len(quizbot.question_bank.categories)]
+        level = next(iter(quizbot.question_bank.levels[category]))
+        count = min(answers, len(quizbot.question_bank.pool(category, level)))
+        yield "start", self.message(user_id, "/start")
+        yield "category", self.callback(user_id, f"cat_{category}")
+        yield "difficulty", self.callback(user_id, f"diff_{level}")
+        yield "count", self.message(user_id, str(count))
+        yield "timer", self.message(user_id, str(minutes))
+        for i in range(count):
+            # Answer buttons are signed per question, press one of those last shown
+            keyboard = quizbot.bot.session.keyboards[user_id]
+            yield "answer", self.callback(user_id, keyboard.inline_keyboard[i % 4][0].callback_data)
+
+def disable_rate_limits():
+    """Lift the outbound limits so runs measure the bot, not Telegram's quotas"""
+    quizbot.GLOBAL_RATE = quizbot.GLOBAL_BURST = 1e9
+    quizbot.CHAT_RATE = quizbot.CHAT_BURST = 1e9
+    quizbot.outbound_limiter = quizbot.OutboundLimiter()
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def post_flows(users: int, answers: int, port: int, secret: str):
+    """POST every user's flow to the local webhook, users running concurrently"""
+    factory = UpdateFactory()
+    url = f"http://127.0.0.1:{port}{quizbot.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+
+    async def run_user(http: ClientSession, user_id: int):
+        for _, update in factory.flow(user_id, answers):
+            started = time.perf_counter()
+            async with http.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    async with ClientSession() as http:
+        await asyncio.gather(*(run_user(http, 1_000_000 + i) for i in range(users)))
+    return latencies
+
+async def main():
+    parser = argparse.ArgumentParser(description="Webhook load harness")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--answers", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency in seconds")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the production outbound rate limits")
+    args = parser.parse_args()
+
+    if not args.rate_limits:
+        disable_rate_limits()
+    quizbot.MAX_SESSIONS = max(quizbot.MAX_SESSIONS, args.users)
+    quizbot.bot.session = FakeSession(args.latency)
+    await quizbot.on_startup()
+
+    # Answer each POST only after its handler ran, so a user's steps stay in order
+    runner = web.AppRunner(quizbot.create_webhook_app(handle_in_background=False))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    try:
+        started = time.perf_counter()
+        latencies = await post_flows(args.users, args.answers, args.port, quizbot.WEBHOOK_SECRET)
+        await quizbot.in_flight.drain(quizbot.DRAIN_TIMEOUT)
+        elapsed = time.perf_counter() - started
+    finally:
+        await site.stop()
+        await runner.cleanup()
+        await quizbot.on_shutdown()
+
+    print(f"updates:     {len(latencies)}")
+    print(f"elapsed:     {elapsed:.2f}s")
+    print(f"updates/s:   {len(latencies) / elapsed:.0f}")
+    print(f"POST p50:    {percentile(latencies, 0.50) * 1000:.2f}ms")
+    print(f"POST p99:    {percentile(latencies, 0.99) * 1000:.2f}ms")
+    print(f"API calls:   {quizbot.bot.session.calls}")
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))